@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Kamkalima API, used to run and benchmark the chef
+without network access or OAuth credentials. It implements:
+
+  - POST /oauth/token                 client_credentials grant
+  - GET  /api/v1/content/texts?page=N  paginated text items
+  - GET  /api/v1/content/audios?page=N paginated audio items
+  - GET  /media/images/<n>.jpg        splash images / thumbnails, real JPEGs (ETag, 304)
+  - GET  /media/audio/<id>.mp3        audio files (ETag, 304, Range requests)
+
+The catalog is generated deterministically from `seed`, and the server can
+add a fixed `latency` to every request and answer a fraction `error_rate` of
+the requests with an HTTP 500 error. With `max_concurrency`, requests above
+that many in flight are answered with an HTTP 429 and a `Retry-After` header,
+and with `token_ttl` the access tokens expire after that many seconds.
+
+Run the chef against it using:
+
+    ./benchmarks/fake_kamkalima_server.py --port 8000 --texts 500 &
+    KAMKALIMA_API_DOMAIN=http://127.0.0.1:8000 ./sushichef.py dryrun
+"""
+
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+FAKE_ACCESS_TOKEN = "fake-kamkalima-access-token"
+GRADE_LEVELS = [4, 7, 10]
+THEMES = ["الأسرة", "البيئة", "الصحة", "العلوم", "الفنون", "الرياضة", "التاريخ", "المجتمع"]
+WORDS = ["كان", "في", "قديم", "الزمان", "رجل", "يعيش", "مع", "أسرته", "قرب", "النهر"]
+QUESTION_CATEGORIES = {
+    "text": ["comprehension", "grammar", "vocabulary"],
+    "audio": ["listening", "vocabulary"],
+}
+
+
+class FakeCatalog(object):
+    """
+    Deterministic catalog of text and audio items similar to the Kamkalima API.
+    """
+
+    def __init__(self, base_url, num_texts=200, num_audios=100, num_images=50,
+                 words_per_text=300, image_width=1200, image_height=900, audio_size=500000, seed=0):
+        self.base_url = base_url
+        self.num_images = num_images
+        self.words_per_text = words_per_text
+        self.image_width = image_width
+        self.image_height = image_height
+        self._images = {}  # name --> JPEG bytes
+        self.audio_size = audio_size
+        self.seed = seed
+        self.items = {
+            "texts": [self.make_item("text", 1000 + i) for i in range(num_texts)],
+            "audios": [self.make_item("audio", 5000 + i) for i in range(num_audios)],
+        }
+
+    def make_item(self, item_type, item_id):
+        rng = random.Random("%s-%s" % (self.seed, item_id))
+        words = [rng.choice(WORDS) for _ in range(self.words_per_text)]
+        time_object = {}
+        position = 0.0
+        for index, word in enumerate(words):
+            duration = round(rng.uniform(0.2, 0.6), 2)
+            time_object[str(index)] = {"start": round(position, 2), "end": round(position + duration, 2)}
+            position += duration
+        # Placeholder markup: it only gives the bodies a realistic size. The
+        # real Kamkalima word markup is unknown, so it says nothing about the
+        # element ids the highlighter script looks for.
+        body = "<p>" + " ".join(
+            '<span id="w%d">%s</span>' % (index, word) for index, word in enumerate(words)
+        ) + "</p>"
+        questions = {}
+        for category in QUESTION_CATEGORIES[item_type]:
+            num_questions = rng.choice([0, 2, 4, 6])
+            questions[category] = [
+                {
+                    "id": item_id * 100 + len(questions) * 10 + question_index,
+                    "title": "سؤال %d" % question_index,
+                    "answers": [
+                        {"title": "جواب %d" % answer_index, "is_correct": answer_index == 0}
+                        for answer_index in range(4)
+                    ],
+                }
+                for question_index in range(num_questions)
+            ]
+        return {
+            "id": item_id,
+            "title": "%s %d" % ("نص" if item_type == "text" else "تسجيل", item_id),
+            "excerpt": " ".join(words[:20]),
+            "body": body,
+            "author": {"name": "كم كلمة"},
+            "time_object": json.dumps(time_object),
+            "image": "%s/media/images/%d.jpg" % (self.base_url, item_id % self.num_images),
+            "audio": "%s/media/audio/%d.mp3" % (self.base_url, item_id),
+            "min_level": rng.choice(GRADE_LEVELS),
+            "max_level": 12,
+            "themes": [{"name": name} for name in rng.sample(THEMES, rng.choice([1, 2, 3]))],
+            "questions": questions,
+        }
+
+    def get_page(self, kind, path, page, per_page):
+        items = self.items[kind]
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        next_page_url = None
+        if page < last_page:
+            next_page_url = "%s%s?page=%d" % (self.base_url, path, page + 1)
+        return {
+            "current_page": page,
+            "last_page": last_page,
+            "per_page": per_page,
+            "total": len(items),
+            "next_page_url": next_page_url,
+            "items": items[(page - 1) * per_page:page * per_page],
+        }
+
+    def get_media(self, name, size):
+        """
+        Return `size` deterministic pseudo-random bytes for the media file `name`.
+        """
+        chunks = []
+        block = hashlib.sha256(("%s-%s" % (self.seed, name)).encode("utf-8")).digest()
+        while len(chunks) * len(block) < size:
+            block = hashlib.sha256(block).digest()
+            chunks.append(block)
+        return b"".join(chunks)[:size]
+
+    def get_image(self, name):
+        """
+        Return a deterministic `image_width` x `image_height` JPEG for the image
+        `name`: a smooth blend of random colors, so that it can be decoded,
+        resized and recompressed like a real photo.
+        """
+        if name not in self._images:
+            import io
+            from PIL import Image
+            rng = random.Random("%s-%s" % (self.seed, name))
+            colors = Image.new("RGB", (16, 12))
+            colors.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+            image = colors.resize((self.image_width, self.image_height), Image.BICUBIC)
+            image_file = io.BytesIO()
+            image.save(image_file, "JPEG", quality=90)
+            self._images[name] = image_file.getvalue()
+        return self._images[name]
+
+
+class FakeKamkalimaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _should_fail(self):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.num_requests += 1
+            return server.rng.random() < server.error_rate
+
+    def _handle(self, handler):
+        """
+        Call `handler`, or answer with a 429 when too many requests are in flight.
+        """
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            throttled = server.max_concurrency and server.in_flight > server.max_concurrency
+            if throttled:
+                server.num_throttled += 1
+        try:
+            if throttled:
+                return self._send(429, b'{"error": "too many requests"}', headers={"Retry-After": "1"})
+            handler()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _is_authorized(self):
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        with self.server.lock:
+            issued_at = self.server.tokens.get(token)
+        if issued_at is None:
+            return False
+        return not self.server.token_ttl or time.time() - issued_at < self.server.token_ttl
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self._handle(self._post)
+
+    def _post(self):
+        if self._should_fail():
+            return self._send_json(500, {"error": "injected error"})
+        if urlparse(self.path).path != "/oauth/token":
+            return self._send_json(404, {"error": "not found"})
+        with self.server.lock:
+            self.server.num_tokens += 1
+            access_token = FAKE_ACCESS_TOKEN
+            if self.server.token_ttl:
+                access_token += "-%d" % self.server.num_tokens
+            self.server.tokens[access_token] = time.time()
+        expires_in = self.server.token_ttl or 3600
+        self._send_json(200, {"access_token": access_token, "token_type": "Bearer", "expires_in": expires_in})
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def _get(self):
+        if self._should_fail():
+            return self._send_json(500, {"error": "injected error"})
+        parsed = urlparse(self.path)
+        catalog = self.server.catalog
+        api_match = re.match(r"^/api/v1/content/(texts|audios)$", parsed.path)
+        if api_match:
+            if not self._is_authorized():
+                return self._send_json(401, {"error": "unauthorized"})
+            page = int(parse_qs(parsed.query).get("page", ["1"])[0])
+            data = catalog.get_page(api_match.group(1), parsed.path, page, self.server.per_page)
+            return self._send_json(200, data)
+        media_match = re.match(r"^/media/(images|audio)/(\d+)\.(jpg|mp3)$", parsed.path)
+        if media_match:
+            if media_match.group(1) == "images":
+                return self._send_media(catalog.get_image(parsed.path), "image/jpeg")
+            content = catalog.get_media(parsed.path, catalog.audio_size)
+            return self._send_media(content, "audio/mpeg")
+        self._send_json(404, {"error": "not found"})
+
+    def _send_media(self, content, content_type):
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, headers={"ETag": etag})
+        range_match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+        if range_match and self.headers.get("If-Range") in (None, etag):
+            start = int(range_match.group(1))
+            if start >= len(content):
+                return self._send(416, headers={"ETag": etag, "Content-Range": "bytes */%d" % len(content)})
+            headers = {
+                "ETag": etag,
+                "Content-Range": "bytes %d-%d/%d" % (start, len(content) - 1, len(content)),
+            }
+            return self._send(206, content[start:], content_type, headers)
+        self._send(200, content, content_type, {"ETag": etag, "Accept-Ranges": "bytes"})
+
+
+def start_fake_server(port=0, num_texts=200, num_audios=100, per_page=20, latency=0.0,
+                      error_rate=0.0, max_concurrency=0, token_ttl=0, seed=0, **catalog_kwargs):
+    """
+    Start the fake server in a background thread. Returns the server, whose
+    `base_url`, `num_requests`, `num_throttled`, `num_tokens` and `bytes_sent`
+    attributes describe the run.
+    Call `server.shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeKamkalimaHandler)
+    server.daemon_threads = True
+    server.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    server.catalog = FakeCatalog(
+        server.base_url, num_texts=num_texts, num_audios=num_audios, seed=seed, **catalog_kwargs
+    )
+    server.per_page = per_page
+    server.latency = latency
+    server.error_rate = error_rate
+    server.max_concurrency = max_concurrency
+    server.token_ttl = token_ttl
+    server.tokens = {}
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.num_requests = 0
+    server.num_throttled = 0
+    server.num_tokens = 0
+    server.in_flight = 0
+    server.bytes_sent = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--texts", type=int, default=200, help="Number of text items.")
+    parser.add_argument("--audios", type=int, default=100, help="Number of audio items.")
+    parser.add_argument("--per-page", type=int, default=20, help="Items per API page.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each request.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500.")
+    parser.add_argument("--max-concurrency", type=int, default=0,
+                        help="Answer requests above this many in flight with HTTP 429 (0 = no limit).")
+    parser.add_argument("--token-ttl", type=float, default=0,
+                        help="Seconds after which access tokens expire (0 = never).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed used to generate the catalog.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Kamkalima API.")
+    parser.add_argument("--port", type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = start_fake_server(
+        port=args.port,
+        num_texts=args.texts,
+        num_audios=args.audios,
+        per_page=args.per_page,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency,
+        token_ttl=args.token_ttl,
+        seed=args.seed,
+    )
+    print("Fake Kamkalima server listening on " + server.base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmarks of the chef against the local fake Kamkalima server.
+Each benchmark runs in a fresh process with empty caches and reports the
+throughput (items/sec), the peak RSS of the process and the bytes fetched.
+
+    ./benchmarks/run_benchmarks.py --texts 500 --audios 200 --latency 0.05
+
+Use `--json results.json` to save the results, e.g. to compare two branches.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from fake_kamkalima_server import add_server_arguments, start_fake_server
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_chef_workdir(base_url):
+    """
+    Import the chef configured to use the fake server at `base_url`, inside a
+    fresh temporary working directory (so all chefdata/ caches start empty).
+    """
+    os.environ["KAMKALIMA_API_DOMAIN"] = base_url
+    sys.path.insert(0, REPO_DIR)
+    import sushichef
+    from ricecooker import config
+
+    workdir = tempfile.mkdtemp(prefix="kamkalima-bench-")
+    shutil.copytree(
+        os.path.join(REPO_DIR, sushichef.HTML5APP_TEMPLATE),
+        os.path.join(workdir, sushichef.HTML5APP_TEMPLATE),
+    )
+    os.makedirs(os.path.join(workdir, "credentials"))
+    with open(os.path.join(workdir, sushichef.CLIENT_CREDENTIALS_PATH), "w") as credentials_file:
+        json.dump({"client_id": "benchmark", "client_secret": "benchmark"}, credentials_file)
+    os.chdir(workdir)
+    config.STORAGE_DIRECTORY = os.path.join(workdir, "storage")
+    return sushichef, workdir
+
+
+def fetch_all_items(sushichef, page_workers):
+    access_token = sushichef.get_authentication_token()
+    all_texts_items = sushichef.get_all_items(
+        sushichef.API_TEXTS_ENDPOINT, access_token, max_workers=page_workers
+    )
+    all_audios_items = sushichef.get_all_items(
+        sushichef.API_AUDIOS_ENDPOINT, access_token, max_workers=page_workers
+    )
+    return all_texts_items, all_audios_items
+
+
+# BENCHMARKS
+# Each benchmark does its setup, then returns (number of items processed, timed function)
+################################################################################
+
+def bench_get_all_items(sushichef, options):
+    def run():
+        all_texts_items, all_audios_items = fetch_all_items(sushichef, options.page_workers)
+        return len(all_texts_items) + len(all_audios_items)
+    return run
+
+
+def bench_build_item_index(sushichef, options):
+    all_texts_items, all_audios_items = fetch_all_items(sushichef, options.page_workers)
+    def run():
+        for _ in range(options.repeat):
+            sushichef.build_item_index(all_texts_items, all_audios_items)
+        return (len(all_texts_items) + len(all_audios_items)) * options.repeat
+    return run
+
+
+def bench_make_html5zip_from_text_item(sushichef, options):
+    all_texts_items, all_audios_items = fetch_all_items(sushichef, options.page_workers)
+    media_cache = sushichef.MediaCache()
+    audio_filenames = sushichef.prefetch_audio_files(
+        all_texts_items, media_cache, max_workers=options.audio_workers
+    )
+    os.makedirs(sushichef.HTML5APP_ZIPS_LOCAL_DIR, exist_ok=True)
+    def run():
+        for text_item in all_texts_items:
+            sushichef.make_html5zip_from_text_item(
+                text_item, media_cache=media_cache, audio_filenames=audio_filenames
+            )
+        return len(all_texts_items)
+    return run
+
+
+def bench_full_tree_build(sushichef, options):
+    chef = sushichef.KamkalimaChef()
+    args, _ = chef.arg_parser.parse_known_args([
+        "dryrun",
+        "--page-workers", str(options.page_workers),
+        "--zip-workers", str(options.zip_workers),
+        "--audio-workers", str(options.audio_workers),
+    ] + (["--optimize-images"] if options.optimize_images else []))
+    args = vars(args)
+    def run():
+        chef.pre_run(args, {})
+        return options.texts + options.audios
+    return run
+
+
+BENCHMARKS = [
+    ("get_all_items", bench_get_all_items),
+    ("build_item_index", bench_build_item_index),
+    ("make_html5zip_from_text_item", bench_make_html5zip_from_text_item),
+    ("full_tree_build", bench_full_tree_build),
+]
+
+
+def run_benchmark(name, base_url, options):
+    """
+    Run the benchmark `name` (in a child process) and return its results.
+    """
+    sushichef, workdir = setup_chef_workdir(base_url)
+    benchmark = dict(BENCHMARKS)[name]
+    try:
+        run = benchmark(sushichef, options)
+        sushichef.STATS.reset()
+        baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        num_items = run()
+        elapsed = time.perf_counter() - start
+        counters = sushichef.STATS.get_report()["counters"]
+        return dict(
+            benchmark=name,
+            items=num_items,
+            seconds=round(elapsed, 3),
+            items_per_sec=round(num_items / elapsed, 1) if elapsed else None,
+            baseline_rss_mb=round(baseline_rss_kb / 1024.0, 1),
+            peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            bytes_fetched=sum(value for key, value in counters.items() if key.endswith(".bytes")),
+        )
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_server_arguments(parser)
+    parser.add_argument("--page-workers", type=int, default=8)
+    parser.add_argument("--zip-workers", type=int, default=4)
+    parser.add_argument("--audio-workers", type=int, default=4)
+    parser.add_argument("--optimize-images", action="store_true",
+                        help="Optimize the images in the full tree build.")
+    parser.add_argument("--repeat", type=int, default=20, help="Repetitions of the in-memory benchmarks.")
+    parser.add_argument("--only", action="append", help="Only run the benchmarks with this name.")
+    parser.add_argument("--json", help="Save the results to this json file.")
+    options = parser.parse_args()
+
+    server = start_fake_server(
+        num_texts=options.texts,
+        num_audios=options.audios,
+        per_page=options.per_page,
+        latency=options.latency,
+        error_rate=options.error_rate,
+        max_concurrency=options.max_concurrency,
+        token_ttl=options.token_ttl,
+        seed=options.seed,
+    )
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name, _ in BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            results.append(pool.apply(run_benchmark, (name, server.base_url, options)))
+    server.shutdown()
+
+    columns = ["benchmark", "items", "seconds", "items_per_sec", "baseline_rss_mb", "peak_rss_mb", "bytes_fetched"]
+    row_format = "%-28s" + "  %14s" * (len(columns) - 1)
+    print(row_format % tuple(columns))
+    for result in results:
+        print(row_format % tuple(result[column] for column in columns))
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump(dict(options=vars(options), results=results), json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+/*
+ * Highlights the word of the text that is being read in the audio player.
+ * The chef precomputes a compact timing table of the words sorted by start
+ * time, with times in milliseconds and delta-encoded:
+ *   {s: [start - previous start], d: [end - start], i: [id - previous id]}
+ * (or k: [word id] when the ids are not integers). The current word is found
+ * by binary search.
+ * The markup of the words in the Kamkalima text bodies is not documented, so
+ * the element of a word is looked up by `data-word-id="<word id>"`, then by
+ * id `w<word id>`, then by id `<word id>`; words with no such element are
+ * simply not highlighted.
+ */
+var textHighlighter = (function () {
+  var HIGHLIGHT_CLASS = 'highlighted-word';
+  var starts = [];
+  var ends = [];
+  var wordIds = [];
+  var currentElement = null;
+  var wordElements = {};  // word id --> element (or null), looked up once
+
+  function getWordElement(wordId) {
+    var key = String(wordId);
+    if (!wordElements.hasOwnProperty(key)) {
+      var attributeValue = key.replace(/["\\]/g, '\\$&');
+      wordElements[key] = (
+        document.querySelector('[data-word-id="' + attributeValue + '"]') ||
+        document.getElementById('w' + key) ||
+        document.getElementById(key)
+      );
+    }
+    return wordElements[key];
+  }
+
+  function decodeTimeTable(timeTable) {
+    var start = 0;
+    var wordId = 0;
+    starts = [];
+    ends = [];
+    wordIds = [];
+    for (var index = 0; index < timeTable.s.length; index++) {
+      start += timeTable.s[index];
+      starts.push(start / 1000);
+      ends.push((start + timeTable.d[index]) / 1000);
+      if (timeTable.k) {
+        wordIds.push(timeTable.k[index]);
+      } else {
+        wordId += timeTable.i[index];
+        wordIds.push(wordId);
+      }
+    }
+  }
+
+  function findWordId(currentTime) {
+    // index of the last word that starts at or before currentTime
+    var low = 0;
+    var high = starts.length - 1;
+    var found = -1;
+    while (low <= high) {
+      var middle = (low + high) >> 1;
+      if (starts[middle] <= currentTime) {
+        found = middle;
+        low = middle + 1;
+      } else {
+        high = middle - 1;
+      }
+    }
+    if (found >= 0 && currentTime < ends[found]) {
+      return wordIds[found];
+    }
+    return null;
+  }
+
+  function highlight(wordId) {
+    var element = wordId === null ? null : getWordElement(wordId);
+    if (element === currentElement) {
+      return;
+    }
+    if (currentElement) {
+      currentElement.classList.remove(HIGHLIGHT_CLASS);
+    }
+    if (element) {
+      element.classList.add(HIGHLIGHT_CLASS);
+    }
+    currentElement = element;
+  }
+
+  function setTimeTable(timeTable) {
+    decodeTimeTable(timeTable || {s: [], d: [], i: []});
+    var player = document.getElementById('audio-player');
+    if (!player) {
+      return;
+    }
+    player.addEventListener('timeupdate', function () {
+      highlight(findWordId(player.currentTime));
+    });
+    player.addEventListener('ended', function () {
+      highlight(null);
+    });
+  }
+
+  return {
+    setTimeTable: setTimeTable,
+  };
+})();
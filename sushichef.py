@@ -1,23 +1,44 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
-from jinja2 import Template
+import argparse
+import cProfile
+import fcntl
+from contextlib import contextmanager, nullcontext
+import hashlib
+from collections import defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, wraps
+import importlib.util
 import json
+import logging
+import math
+import multiprocessing
 import os
-import requests
+import re
 import pprint
+import pstats
+import queue
+import random
 import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zipfile
+from urllib.parse import urlparse
 
 from le_utils.constants import content_kinds, exercises, file_types, licenses, format_presets
 from le_utils.constants.languages import getlang
-from ricecooker.chefs import JsonTreeChef
-from ricecooker.config import LOGGER
-from ricecooker.classes.licenses import get_license
-from ricecooker.utils.html_writer import HTMLWriter
-from ricecooker.utils.jsontrees import write_tree_to_json_tree
-from ricecooker.classes.files import AudioFile
-from ricecooker import config
+
+# requests, ricecooker, jinja2 and Pillow are imported where they are used, so
+# that the stage commands (see the CLI section) only load what they need. ricecooker
+# logs to the root logger.
+LOGGER = logging.getLogger()
 
 
 
@@ -25,29 +46,243 @@ from ricecooker import config
 ################################################################################
 KAMKALIMA_DOMAIN = "https://kamkalima.com"
 KAMKALIMA_CHANNEL_DESCRIPTION = """تقدم المصادر التعليمية الخاصة باللغة العربية من منصة كم كلمة محتوى عربي متفاعل لمتعلمي ومعلمي المرحلة الثانوية. وتمكن النصوص والأنشطة التفاعلية المتعلمين من تطوير مهارات الاستماع والقراءة بالإضافة إلى مهارات وقواعد الكتابة العربية. وتقدم القناة للمعلمين مجموعة من الأدوات التربوية لتمكنهم من متابعة تقدم وتعلم المتعلمين على اختلاف مستوياتهم."""
-KAMKALIMA_LICENSE = get_license(
-    licenses.CC_BY_NC_ND, copyright_holder="Kamkalima"
-).as_dict()
+KAMKALIMA_LANGUAGE = getlang("ar").code
+
+
+@lru_cache(maxsize=None)
+def get_kamkalima_license():
+    from ricecooker.classes.licenses import get_license
+    return get_license(licenses.CC_BY_NC_ND, copyright_holder="Kamkalima").as_dict()
+
 
 # KAMKALIMA API
 ################################################################################
-AUTHORIZATION_ENDPOINT = KAMKALIMA_DOMAIN + "/oauth/token"
-API_AUDIOS_ENDPOINT = KAMKALIMA_DOMAIN + "/api/v1/content/audios"
-API_TEXTS_ENDPOINT = KAMKALIMA_DOMAIN + "/api/v1/content/texts"
+# Set the env var KAMKALIMA_API_DOMAIN to run against a local stand-in server,
+# e.g. the one in benchmarks/fake_kamkalima_server.py
+KAMKALIMA_API_DOMAIN = os.environ.get("KAMKALIMA_API_DOMAIN", KAMKALIMA_DOMAIN)
+AUTHORIZATION_ENDPOINT = KAMKALIMA_API_DOMAIN + "/oauth/token"
+API_AUDIOS_ENDPOINT = KAMKALIMA_API_DOMAIN + "/api/v1/content/audios"
+API_TEXTS_ENDPOINT = KAMKALIMA_API_DOMAIN + "/api/v1/content/texts"
 
 CLIENT_CREDENTIALS_PATH = "credentials/client_credentials.json"
 
+# Pagination: pages are fetched concurrently over a single pooled session
+PAGE_FETCH_WORKERS = 8
+HTTP_POOL_SIZE = 16
+PAGE_PARAM_RE = re.compile(r"([?&]page=)(\d+)")
+
+# Request scheduler shared by all Kamkalima HTTP traffic (API, images, audio)
+HTTP_INITIAL_CONCURRENCY = 4
+HTTP_MAX_CONCURRENCY = HTTP_POOL_SIZE
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+HTTP_BACKOFF_MAX = 30.0
+HTTP_TIMEOUT = (10, 60)  # connect and read timeouts, in seconds
+
+# Persistent cache of API page responses (revalidated with conditional GETs)
+API_CACHE_DIR = os.path.join("chefdata", "api_cache")
+
+
+# Persistent cache of downloaded media files (splash images, thumbnails, audio)
+MEDIA_CACHE_DIR = os.path.join("chefdata", "media_cache")
+MEDIA_CHUNK_SIZE = 64 * 1024
+AUDIO_PREFETCH_WORKERS = 4
+IMAGE_WORKERS = 4  # thumbnails copied into storage concurrently
+
+# Optional image optimization (--optimize-images)
+OPTIMIZED_IMAGES_DIR = os.path.join("chefdata", "optimized_images")
+IMAGE_MAX_WIDTH = 800
+IMAGE_MAX_HEIGHT = 800
+IMAGE_QUALITY = 75
+
+# Optional audio transcoding with ffmpeg (--transcode-audio)
+TRANSCODED_AUDIO_DIR = os.path.join("chefdata", "transcoded_audio")
+AUDIO_BITRATE = "32k"
+AUDIO_CHANNELS = 1
+AUDIO_SAMPLE_RATE = 22050
+AUDIO_SYNC_TOLERANCE = 0.1  # max duration change (seconds) that keeps time_object in sync
+
 
 HTML5APP_ZIPS_LOCAL_DIR = "chefdata/zipfiles"
 HTML5APP_TEMPLATE = "chefdata/html5app_template"
+ZIP_BUILD_WORKERS = 4
 
 # CONSTANTS
 FAILED_NODES = os.path.join('chefdata', 'failed_nodes')
-FAILED_NODES_JSON = os.path.join(FAILED_NODES, 'failed_nodes.json')
+FAILED_NODES_JSONL = os.path.join(FAILED_NODES, 'failed_nodes.jsonl')
+RUN_REPORT_JSON = os.path.join('chefdata', 'run_report.json')
+PROFILES_DIR = os.path.join('chefdata', 'profiles')
+ITEM_MANIFEST_JSON = os.path.join('chefdata', 'item_manifest.json')
+SUBTREES_DIR = os.path.join('chefdata', 'subtrees')
+# Items fetched from the API; the heavy fields are read from disk only when used
+ITEM_STORE_PATH = os.path.join('chefdata', 'item_store.sqlite3')
+ITEM_HEAVY_FIELDS = ("body", "time_object", "questions")
+# Sharded builds: output directory of the shard subtrees and reports
+SHARDS_DIR = os.path.join('chefdata', 'shards')
+
+
+# RUN STATISTICS
+################################################################################
+
+class RunStats(object):
+    """
+    Thread-safe collector of wall time, call counts, bytes transferred and cache
+    hits for the stages of a chef run. Use `stage` for top-level stages (these
+    are also profiled with cProfile when `profile` is set) and `timed` for the
+    individual calls made from worker threads. cProfile only sees the thread
+    that enables it, so the functions run on thread pools are wrapped with
+    `profiled` to add their calls to the profile of the stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._worker_stats = []  # one {"stats": pstats.Stats} per profiled stage in progress
+        self.reset()
+
+    def reset(self, profile=False):
+        with self._lock:
+            self.profile = profile
+            self.timings = {}  # name --> {"wall_time": seconds, "calls": count}
+            self.counters = defaultdict(int)
+            self.info = {}  # other json-serializable details about the run
+
+    def _add_timing(self, name, elapsed):
+        with self._lock:
+            timing = self.timings.setdefault(name, {"wall_time": 0.0, "calls": 0})
+            timing["wall_time"] += elapsed
+            timing["calls"] += 1
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_timing(name, time.perf_counter() - start)
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        if self.profile and not getattr(self._local, "profiling", False):
+            profiler = cProfile.Profile()
+            worker_stats = {"stats": None}
+            with self._lock:
+                self._worker_stats.append(worker_stats)
+            self._local.profiling = True
+            profiler.enable()
+        try:
+            with self.timed("stage:" + name):
+                yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self._local.profiling = False
+                with self._lock:
+                    self._worker_stats.remove(worker_stats)
+                stats = pstats.Stats(profiler)
+                if worker_stats["stats"] is not None:
+                    stats.add(worker_stats["stats"])
+                os.makedirs(PROFILES_DIR, exist_ok=True)
+                stats.dump_stats(os.path.join(PROFILES_DIR, name + ".prof"))
+
+    def profiled(self, function):
+        """
+        Wrap `function`, which runs on a worker thread, so that its calls are
+        added to the profiles of the stages in progress when `profile` is set.
+        """
+        @wraps(function)
+        def profiled_function(*args, **kwargs):
+            with self._lock:
+                worker_stats = list(self._worker_stats)
+            if not worker_stats or getattr(self._local, "profiling", False):
+                return function(*args, **kwargs)
+            profiler = cProfile.Profile()
+            self._local.profiling = True
+            profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+                self._local.profiling = False
+                stats = pstats.Stats(profiler)
+                with self._lock:
+                    for stage_stats in worker_stats:
+                        if stage_stats["stats"] is None:
+                            stage_stats["stats"] = pstats.Stats(profiler)
+                        else:
+                            stage_stats["stats"].add(stats)
+        return profiled_function
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def add_bytes(self, name, num_bytes):
+        self.count(name + ".bytes", num_bytes)
+
+    def cache_lookup(self, name, hit):
+        self.count(name + (".hits" if hit else ".misses"))
+
+    def set_info(self, name, value):
+        with self._lock:
+            self.info[name] = value
+
+    def get_report(self):
+        with self._lock:
+            cache_hit_rates = {}
+            for key in self.counters:
+                if key.endswith(".hits") or key.endswith(".misses"):
+                    name = key.rsplit(".", 1)[0]
+                    hits = self.counters.get(name + ".hits", 0)
+                    total = hits + self.counters.get(name + ".misses", 0)
+                    cache_hit_rates[name] = round(hits / float(total), 4) if total else None
+            return dict(
+                timings={name: dict(timing) for name, timing in self.timings.items()},
+                counters=dict(self.counters),
+                cache_hit_rates=cache_hit_rates,
+                info=dict(self.info),
+            )
+
+    def write_report(self, report_path=RUN_REPORT_JSON):
+        """
+        Log a summary of the run and save the full report as json.
+        """
+        report = self.get_report()
+        for name, timing in sorted(report["timings"].items()):
+            LOGGER.info("  %-28s %9.2fs  %7d calls" % (name, timing["wall_time"], timing["calls"]))
+        for name, hit_rate in sorted(report["cache_hit_rates"].items()):
+            LOGGER.info("  %-28s hit rate %s" % (name, hit_rate))
+        for name, value in sorted(report["counters"].items()):
+            if name.endswith(".bytes"):
+                LOGGER.info("  %-28s %12d bytes" % (name[:-len(".bytes")], value))
+        with open(report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+STATS = RunStats()
+
+_FAILED_NODES_LOCK = threading.Lock()
+
+# Identifies the failures of this run (and of its forked shard workers) in the log
+RUN_ID = time.strftime("%Y%m%dT%H%M%S") + "-" + str(os.getpid())
+
+def record_failed_node(**failure):
+    """
+    Append a json line describing a failure, tagged with the `RUN_ID`, to
+    `FAILED_NODES_JSONL`. The log is never truncated.
+    """
+    STATS.count("failed_nodes")
+    with _FAILED_NODES_LOCK:
+        os.makedirs(FAILED_NODES, exist_ok=True)
+        with open(FAILED_NODES_JSONL, "a", encoding="utf-8") as failed_nodes_file:
+            failed_nodes_file.write(json.dumps(dict(run=RUN_ID, **failure), ensure_ascii=False) + "\n")
+
+
 # AUTHENTICATION API
 ################################################################################
 
-def get_authentication_token():
+def request_access_token():
     """
     Call `/oauth/token` to obtain `access_token` for use with the content API.
     """
@@ -57,7 +292,7 @@ def get_authentication_token():
         "client_id": client_credentials["client_id"],
         "client_secret": client_credentials["client_secret"],
     }
-    response = requests.post(AUTHORIZATION_ENDPOINT, data=data)
+    response = get_scheduler().request("POST", AUTHORIZATION_ENDPOINT, data=data)
     if response.ok:
         access_token = response.json()['access_token']
         LOGGER.info('Successfully obtained authorization token')
@@ -66,37 +301,443 @@ def get_authentication_token():
         raise ConnectionError('Get auth token failed ' + AUTHORIZATION_ENDPOINT)
 
 
+class AccessToken(object):
+    """
+    OAuth access token shared by all API requests, which can be refreshed
+    when it expires during the run.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def refresh(self, stale_value):
+        """
+        Get a new token, unless another thread already replaced `stale_value`.
+        """
+        with self._lock:
+            if self.value == stale_value:
+                LOGGER.info("Access token rejected, requesting a new one")
+                STATS.count("http.token_refreshes")
+                self.value = request_access_token()
+
+
+def get_authentication_token():
+    return AccessToken(request_access_token())
+
+
+# REQUEST SCHEDULER
+################################################################################
+
+class RequestScheduler(object):
+    """
+    Sends every request to Kamkalima (API pages, images, audio) under one
+    adaptive concurrency limit. The limit grows by about one request for each
+    `limit` successful requests and is halved when the server is overloaded
+    (429 and 5xx responses, connection errors), at most once per second.
+    Overloaded requests are retried up to `max_retries` times, after an
+    exponential backoff with full jitter or the `Retry-After` delay of the
+    response, during which no new request is sent. A request rejected with a
+    401 gets its `access_token` refreshed once and is retried.
+    """
+
+    def __init__(self, session, initial_concurrency=HTTP_INITIAL_CONCURRENCY,
+                 max_concurrency=HTTP_MAX_CONCURRENCY, max_retries=HTTP_MAX_RETRIES):
+        self.session = session
+        self.limit = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause <= 0 and self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                self._condition.wait(timeout=pause if pause > 0 else None)
+
+    def _release(self, overloaded=False, retry_after=None):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_decrease > 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+                    STATS.set_info("http_concurrency_limit", int(self.limit))
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def request(self, method, url, access_token=None, headers=None, **kwargs):
+        """
+        Send the request and return the response, with the same arguments as
+        `requests.Session.request`. The `access_token` (an `AccessToken`) is
+        sent as the Authorization header. Raises the last error when a request
+        still fails after all retries; other error responses are returned.
+        """
+        resp = self._send(method, url, access_token, headers, kwargs)
+        self._release()
+        return resp
+
+    @contextmanager
+    def stream(self, method, url, access_token=None, headers=None, **kwargs):
+        """
+        Context manager version of `request` for downloads: the response body
+        is streamed and the request counts towards the concurrency limit until
+        the context exits.
+        """
+        resp = self._send(method, url, access_token, headers, dict(kwargs, stream=True))
+        try:
+            yield resp
+        finally:
+            resp.close()
+            self._release()
+
+    def _send(self, method, url, access_token, headers, kwargs):
+        """
+        Send the request, with retries, and return the final response. The
+        caller must call `_release` once it is done with the response.
+        """
+        import requests
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        refreshed_token = False
+        attempt = 0
+        while True:
+            request_headers = dict(headers or {})
+            if access_token is not None:
+                token_value = access_token.value
+                request_headers["Authorization"] = "Bearer " + token_value
+            self._acquire()
+            try:
+                resp = self.session.request(method, url, headers=request_headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._release(overloaded=True)
+                if attempt >= self.max_retries:
+                    raise
+                error, retry_after = str(e), None
+            except Exception:
+                self._release()
+                raise
+            else:
+                if resp.status_code == 401 and access_token is not None and not refreshed_token:
+                    # Token expired: refresh it once, a second 401 is returned
+                    resp.close()
+                    self._release()
+                    access_token.refresh(token_value)
+                    refreshed_token = True
+                    continue
+                if resp.status_code != 429 and resp.status_code < 500:
+                    return resp
+                if attempt >= self.max_retries:
+                    return resp
+                resp.close()
+                error, retry_after = "response " + str(resp.status_code), get_retry_after(resp)
+                self._release(overloaded=True, retry_after=retry_after)
+                STATS.count("http.throttled" if resp.status_code == 429 else "http.server_errors")
+            delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+            delay = max(delay, retry_after or 0)
+            LOGGER.warning("Retrying %s in %.1fs after %s (attempt %d of %d)" % (
+                url, delay, error, attempt + 1, self.max_retries
+            ))
+            STATS.count("http.retries")
+            time.sleep(delay)
+            attempt += 1
+
+
+def get_retry_after(resp):
+    """
+    Return the delay in seconds of the `Retry-After` header of `resp`, or None.
+    """
+    retry_after = resp.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+def get_scheduler():
+    """
+    Return the `RequestScheduler` shared by all requests to Kamkalima.
+    """
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = RequestScheduler(get_session())
+        return _SCHEDULER
+
+
 
 # API EXTRACT FUNCTIONS
 ################################################################################
 
-def get_all_items(start_url, access_token):
+_SESSION = None
+
+def get_session():
     """
-    Get items from all pages through the API (texts or audios).
+    Return the shared `requests.Session` used for all calls to the Kamkalima API.
+    The session keeps connections alive and its pool is large enough to serve
+    the concurrent page fetches done in `get_all_items`.
     """
-    all_items = []
-    current_url = start_url
-    while True:
-        headers = {
-            'Authorization': 'Bearer ' + access_token
+    global _SESSION
+    import requests
+    from requests.adapters import HTTPAdapter
+    if _SESSION is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _SESSION = session
+    return _SESSION
+
+
+class ApiResponseCache(object):
+    """
+    On-disk cache of API responses keyed by URL. Each entry consists of the
+    response body and a small json file with its `ETag` and `Last-Modified`
+    headers, which are used to revalidate the entry with a conditional GET.
+    In `offline` mode the cache is replayed without making any requests.
+    """
+
+    def __init__(self, cache_dir=API_CACHE_DIR, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        body_path = os.path.join(self.cache_dir, key + ".body")
+        meta_path = os.path.join(self.cache_dir, key + ".json")
+        return body_path, meta_path
+
+    def locked(self, url):
+        """
+        Hold the lock of the entry for `url`, shared with other processes.
+        """
+        body_path, _ = self._get_paths(url)
+        return locked_file(os.path.splitext(body_path)[0] + ".lock")
+
+    def load(self, url):
+        """
+        Return the cached body (bytes) for `url`, or `None` if not cached.
+        """
+        body_path, meta_path = self._get_paths(url)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return None
+        with open(body_path, "rb") as body_file:
+            return body_file.read()
+
+    def get_conditional_headers(self, url):
+        """
+        Return the `If-None-Match` and `If-Modified-Since` headers for `url`.
+        """
+        body_path, meta_path = self._get_paths(url)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return {}
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, url, resp):
+        """
+        Save the body and validators of the response `resp` for `url`.
+        """
+        body_path, meta_path = self._get_paths(url)
+        meta = {
+            "url": url,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
         }
-        LOGGER.debug('GET ' + current_url)
-        resp = requests.get(current_url, headers=headers)
-        if not resp.ok:
-            LOGGER.error("Response " + str(resp.status_code) + " on " + current_url)
-            break
-        data = resp.json()
-        items = data["items"]
+        tmp_body_path = get_temp_path(body_path)
+        with open(tmp_body_path, "wb") as body_file:
+            body_file.write(resp.content)
+        os.replace(tmp_body_path, body_path)
+        tmp_meta_path = get_temp_path(meta_path)
+        with open(tmp_meta_path, "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+        os.replace(tmp_meta_path, meta_path)
+
+
+def get_api_page(url, access_token, cache=None):
+    """
+    GET a single page of API results and return the decoded json data. Raises
+    `requests.HTTPError` if the server responded with an error (after the
+    retries of the `RequestScheduler`). When a `cache` is given, the page is
+    revalidated using a conditional GET (or read from the cache when offline).
+    """
+    if cache is not None and cache.offline:
+        body = cache.load(url)
+        if body is None:
+            raise RuntimeError("Offline mode but no cached response for " + url)
+        LOGGER.debug('CACHED ' + url)
+        STATS.cache_lookup("api_cache", True)
+        return json.loads(body.decode("utf-8"))
+    if cache is None:
+        return _fetch_api_page(url, access_token)
+    # other processes (shard builds, other machines) share the cache
+    with cache.locked(url):
+        return _fetch_api_page(url, access_token, cache)
+
+
+def _fetch_api_page(url, access_token, cache=None):
+    headers = {}
+    if cache is not None:
+        headers.update(cache.get_conditional_headers(url))
+    LOGGER.debug('GET ' + url)
+    with STATS.timed("api_page"):
+        resp = get_scheduler().request("GET", url, access_token=access_token, headers=headers)
+    STATS.add_bytes("api", len(resp.content))
+    if resp.status_code == 304 and cache is not None:
+        LOGGER.debug('Not modified ' + url)
+        STATS.cache_lookup("api_cache", True)
+        return json.loads(cache.load(url).decode("utf-8"))
+    resp.raise_for_status()
+    if cache is not None:
+        STATS.cache_lookup("api_cache", False)
+        cache.store(url, resp)
+    return resp.json()
+
+
+def get_next_page_url(data):
+    """
+    Return `next_page_url` from page `data` if it looks like a valid URL.
+    """
+    next_page_url = data.get("next_page_url")
+    if next_page_url and KAMKALIMA_API_DOMAIN in next_page_url:
+        return next_page_url
+    return None
+
+
+def get_last_page(data):
+    """
+    Return the total number of pages if the API exposes it, otherwise `None`.
+    """
+    if data.get("last_page"):
+        return int(data["last_page"])
+    if data.get("total") and data.get("per_page"):
+        return int(math.ceil(int(data["total"]) / float(data["per_page"])))
+    return None
+
+
+def get_page_url(page_url_template, page_number):
+    """
+    Replace the `page=N` query parameter in `page_url_template` by `page_number`.
+    """
+    return PAGE_PARAM_RE.sub(r"\g<1>" + str(page_number), page_url_template, count=1)
+
+
+def iter_item_pages(start_url, access_token, max_workers=PAGE_FETCH_WORKERS, cache=None):
+    """
+    Generator that yields the list of items of each page of API results (texts
+    or audios), in API order, as soon as the page is available.
+    When the API tells us the number of pages, or when `next_page_url` follows
+    the `page=N` pattern, the remaining pages are fetched concurrently using up
+    to `max_workers` threads.
+    Pass an `ApiResponseCache` as `cache` to revalidate or replay cached pages.
+    Errors are raised rather than truncating the results.
+    """
+    data = get_api_page(start_url, access_token, cache=cache)
+    next_page_url = get_next_page_url(data)
+    yield data["items"]
+
+    match = PAGE_PARAM_RE.search(next_page_url) if next_page_url else None
+    if next_page_url and (max_workers <= 1 or not match):
+        # Sequential fallback: follow next_page_url one page at a time
+        while next_page_url:
+            data = get_api_page(next_page_url, access_token, cache=cache)
+            yield data["items"]
+            next_page_url = get_next_page_url(data)
+
+    elif next_page_url:
+        first_page = int(match.group(2))
+        last_page = get_last_page(data)
+        fetch_page = lambda page: get_api_page(
+            get_page_url(next_page_url, page), access_token, cache=cache
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if last_page:
+                # Keep at most `max_workers` pages in flight ahead of the
+                # consumer, so a slow consumer holds back the fetching
+                page_futures = deque()
+                next_page = first_page
+
+                def submit_pages():
+                    nonlocal next_page
+                    while next_page <= last_page and len(page_futures) < max_workers:
+                        page_futures.append(executor.submit(STATS.profiled(fetch_page), next_page))
+                        next_page += 1
+
+                try:
+                    submit_pages()
+                    while page_futures:
+                        data = page_futures.popleft().result()
+                        submit_pages()
+                        yield data["items"]
+                finally:
+                    for page_future in page_futures:
+                        page_future.cancel()
+            else:
+                # Page count unknown: fetch windows of `max_workers` pages at a
+                # time until we reach a page without a next_page_url (or a
+                # missing page past the end of the results)
+                window_start = first_page
+                reached_end = False
+                while not reached_end:
+                    window = range(window_start, window_start + max_workers)
+                    fetch_window_page = STATS.profiled(lambda page: fetch_page_or_none(fetch_page, page))
+                    for data in executor.map(fetch_window_page, window):
+                        if not data:
+                            reached_end = True
+                            break
+                        yield data["items"]
+                        if not data["items"] or not get_next_page_url(data):
+                            reached_end = True
+                            break
+                    window_start += max_workers
+    LOGGER.debug('Reached end of API results')
+
+
+def fetch_page_or_none(fetch_page, page):
+    """
+    Return `fetch_page(page)`, or None if the page does not exist (404).
+    """
+    import requests
+    try:
+        return fetch_page(page)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+
+
+def get_all_items(start_url, access_token, max_workers=PAGE_FETCH_WORKERS, cache=None):
+    """
+    Get items from all pages through the API (texts or audios), in API order.
+    See `iter_item_pages` for the description of the arguments.
+    """
+    all_items = []
+    for items in iter_item_pages(start_url, access_token, max_workers=max_workers, cache=cache):
         all_items.extend(items)
-        if (
-            "next_page_url" in data
-            and data["next_page_url"]
-            and KAMKALIMA_DOMAIN in data["next_page_url"]
-        ):  # key exists, is not null, and looks like a valid URL
-            current_url = data["next_page_url"]
-        else:
-            LOGGER.debug('Reached end of API results')
-            break
     if all_items:  # > 0
         LOGGER.info("  Found %s items" % len(all_items) )
         return all_items
@@ -104,6 +745,755 @@ def get_all_items(start_url, access_token):
         raise RuntimeError("Kamkalima API not accessible or 0 items returned.")
 
 
+# ITEM STORE
+################################################################################
+
+def get_item_fingerprint(item):
+    """
+    Return a digest of all the fields of the API `item`.
+    """
+    if isinstance(item, StoredItem):
+        return item.fingerprint
+    serialized = json.dumps(item, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+class ItemStore(object):
+    """
+    SQLite store of the items fetched from the API during a run, indexed by
+    item type, id and min_level, so the items don't all stay in memory. The
+    themes of the items are kept in a separate indexed table for grouping.
+    Items are read back as `StoredItem`s, which keep only their lightweight
+    fields in memory and read the ITEM_HEAVY_FIELDS from disk when they are
+    accessed. The store is emptied when it is opened.
+    """
+
+    def __init__(self, path=ITEM_STORE_PATH):
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._next_position = 0
+        heavy_columns = "".join(",\n                " + field + " TEXT" for field in ITEM_HEAVY_FIELDS)
+        with self._lock:
+            self._connection.executescript("""
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                DROP TABLE IF EXISTS items;
+                DROP TABLE IF EXISTS item_themes;
+                CREATE TABLE items (
+                    position INTEGER PRIMARY KEY,
+                    item_type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    min_level INTEGER,
+                    fingerprint TEXT NOT NULL,
+                    fields TEXT NOT NULL%s
+                );
+                CREATE INDEX items_id ON items (item_type, id);
+                CREATE INDEX items_min_level ON items (item_type, min_level, position);
+                CREATE TABLE item_themes (
+                    seq INTEGER PRIMARY KEY,
+                    item_type TEXT NOT NULL,
+                    min_level INTEGER,
+                    theme TEXT NOT NULL,
+                    position INTEGER NOT NULL
+                );
+                CREATE INDEX item_themes_theme ON item_themes (item_type, min_level, theme, seq);
+            """ % heavy_columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def add_items(self, item_type, items):
+        """
+        Save `items` of `item_type`, after the items already in the store, and
+        return them as `StoredItem`s.
+        """
+        rows = []
+        theme_rows = []
+        stored_items = []
+        with self._lock:
+            for item in items:
+                position = self._next_position
+                self._next_position += 1
+                fields = {key: value for key, value in item.items() if key not in ITEM_HEAVY_FIELDS}
+                heavy_fields = [field for field in ITEM_HEAVY_FIELDS if field in item]
+                fingerprint = get_item_fingerprint(item)
+                rows.append([
+                    position, item_type, str(item["id"]), item.get("min_level"), fingerprint,
+                    json.dumps(fields, ensure_ascii=False),
+                ] + [
+                    json.dumps(item[field], ensure_ascii=False) if field in item else None
+                    for field in ITEM_HEAVY_FIELDS
+                ])
+                theme_rows.extend(
+                    (item_type, item.get("min_level"), theme["name"], position) for theme in item["themes"]
+                )
+                stored_items.append(StoredItem(self, position, fingerprint, fields, heavy_fields))
+            placeholders = ", ".join("?" * (6 + len(ITEM_HEAVY_FIELDS)))
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO items (position, item_type, id, min_level, fingerprint, fields, %s)"
+                    " VALUES (%s)" % (", ".join(ITEM_HEAVY_FIELDS), placeholders),
+                    rows,
+                )
+                self._connection.executemany(
+                    "INSERT INTO item_themes (item_type, min_level, theme, position) VALUES (?, ?, ?, ?)",
+                    theme_rows,
+                )
+        return stored_items
+
+    def count_items(self, item_type):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM items WHERE item_type = ?", (item_type,)
+            ).fetchone()[0]
+
+    def get_items(self, item_type, min_level):
+        """
+        Return the items of `item_type` and `min_level`, in API order.
+        """
+        present_columns = "".join(", " + field + " IS NOT NULL" for field in ITEM_HEAVY_FIELDS)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT position, fingerprint, fields%s FROM items"
+                " WHERE item_type = ? AND min_level = ? ORDER BY position" % present_columns,
+                (item_type, min_level),
+            ).fetchall()
+        return [
+            StoredItem(self, position, fingerprint, json.loads(fields), [
+                field for field, is_present in zip(ITEM_HEAVY_FIELDS, present) if is_present
+            ])
+            for position, fingerprint, fields, *present in rows
+        ]
+
+    def load_field(self, position, field):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT %s FROM items WHERE position = ?" % field, (position,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError(field)
+        return json.loads(row[0])
+
+    def get_item_index(self):
+        """
+        Return the same index as `build_item_index` for the stored items. The
+        themes of each grade are read from the theme index already grouped, in
+        the order in which they first appear in the API results.
+        """
+        with self._lock:
+            min_levels = [row[0] for row in self._connection.execute("SELECT DISTINCT min_level FROM items")]
+        unknown_min_levels = [min_level for min_level in min_levels if min_level not in GRADE_KEY]
+        if unknown_min_levels:
+            raise ValueError("unrecognized min_level " + ", ".join(map(str, unknown_min_levels)))
+        present_columns = "".join(", items." + field + " IS NOT NULL" for field in ITEM_HEAVY_FIELDS)
+        item_index = {}
+        for section in CHANNEL_SECTIONS:
+            item_type = section["item_type"]
+            for min_level, grade_level in GRADE_KEY.items():
+                with self._lock:
+                    rows = self._connection.execute(
+                        "SELECT item_themes.theme, items.position, items.fingerprint, items.fields%s"
+                        " FROM item_themes"
+                        " JOIN (SELECT theme, MIN(seq) AS first_seq FROM item_themes"
+                        "       WHERE item_type = ? AND min_level = ? GROUP BY theme) AS first_seen"
+                        "   ON first_seen.theme = item_themes.theme"
+                        " JOIN items ON items.position = item_themes.position"
+                        " WHERE item_themes.item_type = ? AND item_themes.min_level = ?"
+                        " ORDER BY first_seen.first_seq, item_themes.seq" % present_columns,
+                        (item_type, min_level, item_type, min_level),
+                    ).fetchall()
+                stored_items = {}
+                for theme, position, fingerprint, fields, *present in rows:
+                    if position not in stored_items:
+                        stored_items[position] = StoredItem(self, position, fingerprint, json.loads(fields), [
+                            field for field, is_present in zip(ITEM_HEAVY_FIELDS, present) if is_present
+                        ])
+                    item_index.setdefault((item_type, grade_level, theme), []).append(stored_items[position])
+        return item_index
+
+
+class StoredItem(Mapping):
+    """
+    Read-only API item of an `ItemStore`. The lightweight `fields` are kept in
+    memory and the `heavy_fields` are read from the store on every access.
+    """
+    __slots__ = ("store", "position", "fingerprint", "fields", "heavy_fields")
+
+    def __init__(self, store, position, fingerprint, fields, heavy_fields):
+        self.store = store
+        self.position = position
+        self.fingerprint = fingerprint
+        self.fields = fields
+        self.heavy_fields = heavy_fields
+
+    def __getitem__(self, key):
+        if key in ITEM_HEAVY_FIELDS:
+            return self.store.load_field(self.position, key)
+        return self.fields[key]
+
+    def __iter__(self):
+        yield from self.fields
+        yield from self.heavy_fields
+
+    def __len__(self):
+        return len(self.fields) + len(self.heavy_fields)
+
+
+# MEDIA DOWNLOADS
+################################################################################
+
+class MediaCache(object):
+    """
+    URL-keyed on-disk cache of media files. Files are streamed to disk, each URL
+    is downloaded (or revalidated with a conditional GET) at most once per run,
+    and concurrent requests for the same URL wait for the first download.
+    In `offline` mode only the files already in the cache are used.
+    """
+
+    def __init__(self, cache_dir=MEDIA_CACHE_DIR, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._fresh_paths = {}  # url --> local path already validated in this run
+        self._digests = {}  # url --> sha1 of the local copy validated in this run
+
+    def _get_paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        _, ext = os.path.splitext(urlparse(url).path)
+        path = os.path.join(self.cache_dir, key + ext.lower())
+        meta_path = os.path.join(self.cache_dir, key + ".json")
+        return path, meta_path
+
+    def _get_url_lock(self, url):
+        with self._lock:
+            if url not in self._url_locks:
+                self._url_locks[url] = threading.Lock()
+            return self._url_locks[url]
+
+    def get(self, url, category="media"):
+        """
+        Return the path of the local copy of `url`, downloading it if needed.
+        The `category` (e.g. image or audio) is used to group download stats.
+        """
+        with self._get_url_lock(url):
+            if url in self._fresh_paths:
+                STATS.cache_lookup(category + "_cache", True)
+            else:
+                with STATS.timed(category + "_download"):
+                    self._fresh_paths[url] = self._download(url, category)
+            return self._fresh_paths[url]
+
+    def get_digest(self, url, category="media"):
+        """
+        Return the sha1 of the content of `url`, downloading it if needed.
+        """
+        path = self.get(url, category)
+        with self._get_url_lock(url):
+            if url not in self._digests:
+                hasher = hashlib.sha1()
+                with open(path, "rb") as media_file:
+                    for chunk in iter(lambda: media_file.read(MEDIA_CHUNK_SIZE), b""):
+                        hasher.update(chunk)
+                self._digests[url] = hasher.hexdigest()
+            return self._digests[url]
+
+    def _download(self, url, category):
+        path, meta_path = self._get_paths(url)
+        if self.offline:
+            if not (os.path.exists(path) and os.path.exists(meta_path)):
+                raise RuntimeError("Offline mode but no cached media for " + url)
+            STATS.cache_lookup(category + "_cache", True)
+            return path
+        # other processes (shard builds) share the cache and its partial downloads
+        with locked_file(os.path.splitext(meta_path)[0] + ".lock"):
+            return self._fetch(url, category, path, meta_path)
+
+    def _fetch(self, url, category, path, meta_path):
+        is_cached = os.path.exists(path) and os.path.exists(meta_path)
+        headers = {}
+        if is_cached:
+            headers.update(self._get_validator_headers(meta_path, "If-None-Match", "If-Modified-Since"))
+        # Resume an interrupted download if the resource didn't change since
+        part_path, part_meta_path = path + ".part", meta_path + ".part"
+        part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if part_size and os.path.exists(part_meta_path):
+            if_range = self._get_validator_headers(part_meta_path, "If-Range", "If-Range")
+            if if_range:
+                headers.update(if_range)
+                headers["Range"] = "bytes=" + str(part_size) + "-"
+
+        LOGGER.debug('GET ' + url)
+        with get_scheduler().stream("GET", url, headers=headers) as resp:
+            if resp.status_code == 304 and is_cached:
+                LOGGER.debug('Not modified ' + url)
+                STATS.cache_lookup(category + "_cache", True)
+                return path
+            if resp.status_code == 416 and "Range" in headers:
+                # the partial download is already complete (or longer than the
+                # file): start over rather than failing on this url every run
+                LOGGER.debug('Restarting download of ' + url)
+                for stale_path in [part_path, part_meta_path]:
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+                return self._fetch(url, category, path, meta_path)
+            resp.raise_for_status()
+            STATS.cache_lookup(category + "_cache", False)
+            meta = {
+                "url": url,
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
+            if resp.status_code == 206:
+                LOGGER.debug('Resuming download of ' + url + ' at byte ' + str(part_size))
+                mode = "ab"
+            else:
+                mode = "wb"
+                self._write_meta(part_meta_path, meta)
+            with open(part_path, mode) as media_file:
+                for chunk in resp.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                    media_file.write(chunk)
+                    STATS.add_bytes(category, len(chunk))
+        os.replace(part_path, path)
+        self._write_meta(meta_path, meta)
+        if os.path.exists(part_meta_path):
+            os.remove(part_meta_path)
+        return path
+
+    def _get_validator_headers(self, meta_path, etag_header, last_modified_header):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        headers = {}
+        if meta.get("last_modified"):
+            headers[last_modified_header] = meta["last_modified"]
+        if meta.get("etag"):
+            headers[etag_header] = meta["etag"]
+        return headers
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = get_temp_path(meta_path)
+        with open(tmp_path, "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+        os.replace(tmp_path, meta_path)
+
+
+@contextmanager
+def locked_file(lock_path):
+    """
+    Hold an exclusive lock on `lock_path` (created if needed), which works
+    across processes, unlike the per-URL locks of `MediaCache`.
+    """
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_temp_path(path):
+    """
+    Return a temporary path next to `path` that is unique to this writer, so
+    that processes and threads writing the same file don't clobber each
+    other's temporary file before moving it to `path`.
+    """
+    return "%s.%d-%s.tmp" % (path, os.getpid(), uuid.uuid4().hex[:8])
+
+
+def get_storage_path(filename):
+    """
+    Return the path of `filename` in ricecooker's storage directory.
+    """
+    from ricecooker import config
+    # ricecooker checks then creates the directory, which races between our threads
+    os.makedirs(os.path.join(config.STORAGE_DIRECTORY, filename[0], filename[1]), exist_ok=True)
+    return config.get_storage_path(filename)
+
+
+def copy_to_storage(path, default_ext="mp3"):
+    """
+    Copy the file at `path` into ricecooker's storage directory using the same
+    naming scheme as ricecooker (md5 of contents + extension) and return the
+    storage filename.
+    """
+    hasher = hashlib.md5()
+    with open(path, "rb") as media_file:
+        for chunk in iter(lambda: media_file.read(MEDIA_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    _, ext = os.path.splitext(path)
+    filename = hasher.hexdigest() + (ext.lower() if ext else "." + default_ext)
+    storage_path = get_storage_path(filename)
+    if not os.path.exists(storage_path):
+        tmp_path = get_temp_path(storage_path)
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, storage_path)
+    return filename
+
+
+def prefetch_audio_files(items, media_cache, max_workers=AUDIO_PREFETCH_WORKERS, audio_transcoder=None):
+    """
+    Download the audio files of all `items` (texts and audios) concurrently,
+    using at most `max_workers` threads, and copy them into ricecooker storage
+    (transcoded by `audio_transcoder` if given).
+    Returns a dict `{audio_url: storage_filename}`.
+    """
+    audio_urls = []
+    for item in items:
+        if item.get("audio") and item["audio"] not in audio_urls:
+            audio_urls.append(item["audio"])
+    LOGGER.info("Prefetching %s audio files using %s workers" % (len(audio_urls), max_workers))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        audio_filenames = executor.map(
+            STATS.profiled(lambda url: prefetch_audio_file(url, media_cache, audio_transcoder)), audio_urls
+        )
+        return dict(zip(audio_urls, audio_filenames))
+
+
+def prefetch_audio_file(audio_url, media_cache, audio_transcoder=None):
+    """
+    Download `audio_url`, transcode it if an `audio_transcoder` is given, and
+    copy it into ricecooker storage. Returns the storage filename.
+    """
+    audio_path = media_cache.get(audio_url, category="audio")
+    if audio_transcoder is not None:
+        audio_path = audio_transcoder.transcode(audio_path)
+    return copy_to_storage(audio_path, default_ext="mp3")
+
+
+def get_audio_filename(audio_url, audio_filenames=None):
+    """
+    Return the storage filename for `audio_url`, downloading it with ricecooker
+    if it was not prefetched by `prefetch_audio_files`.
+    """
+    if audio_filenames is not None and audio_url in audio_filenames:
+        return audio_filenames[audio_url]
+    from ricecooker.classes.files import AudioFile
+    audio_file = AudioFile(path=audio_url, preset=format_presets.AUDIO_DEPENDENCY)
+    return audio_file.get_filename()
+
+
+class ImageOptimizer(object):
+    """
+    Resizes images to fit within `max_width` x `max_height` and recompresses
+    them as JPEG with the given `quality`. Results are cached on disk by the
+    hash of the source image and the settings. When the optimized image is not
+    smaller than the source, the source image is used as is.
+    """
+
+    def __init__(self, max_width=IMAGE_MAX_WIDTH, max_height=IMAGE_MAX_HEIGHT, quality=IMAGE_QUALITY,
+                 cache_dir=OPTIMIZED_IMAGES_DIR):
+        if importlib.util.find_spec("PIL") is None:
+            raise RuntimeError("Image optimization requires Pillow: pip install Pillow")
+        self.max_width = max_width
+        self.max_height = max_height
+        self.quality = quality
+        self.cache_dir = cache_dir
+        self.settings_key = "%dx%d-q%d" % (max_width, max_height, quality)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self._results = {}  # source path --> (path, original size, optimized size)
+
+    def optimize(self, source_path):
+        """
+        Return `(path, original_size, optimized_size)` for the image at `source_path`.
+        """
+        with self._lock:
+            if source_path not in self._path_locks:
+                self._path_locks[source_path] = threading.Lock()
+            path_lock = self._path_locks[source_path]
+        with path_lock:
+            if source_path not in self._results:
+                with STATS.timed("image_optimize"):
+                    self._results[source_path] = self._optimize(source_path)
+            return self._results[source_path]
+
+    def _optimize(self, source_path):
+        from PIL import Image
+        hasher = hashlib.sha1()
+        with open(source_path, "rb") as source_file:
+            for chunk in iter(lambda: source_file.read(MEDIA_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        original_size = os.path.getsize(source_path)
+        optimized_path = os.path.join(self.cache_dir, hasher.hexdigest() + "-" + self.settings_key + ".jpg")
+        if not os.path.exists(optimized_path):
+            try:
+                image = Image.open(source_path)
+                image.load()
+            except OSError as e:
+                LOGGER.warning("Cannot optimize image " + source_path + ": " + str(e))
+                record_failed_node(path=source_path, reason="image optimization failed: " + str(e))
+                return source_path, original_size, original_size
+            image.thumbnail((self.max_width, self.max_height), Image.LANCZOS)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.split()[-1])
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            tmp_path = get_temp_path(optimized_path)
+            image.save(tmp_path, "JPEG", quality=self.quality, optimize=True, progressive=True)
+            os.replace(tmp_path, optimized_path)
+        optimized_size = os.path.getsize(optimized_path)
+        if optimized_size >= original_size:
+            return source_path, original_size, original_size
+        return optimized_path, original_size, optimized_size
+
+
+def get_audio_profile_key(bitrate, channels, sample_rate):
+    return "%s-%dch-%dhz" % (bitrate, channels, sample_rate)
+
+
+def get_audio_duration(path):
+    """
+    Return the duration of the audio file at `path` in seconds, using ffprobe.
+    """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    return float(result.stdout.decode("utf-8").strip())
+
+
+def transcode_audio_file(input_path, output_path, bitrate, channels, sample_rate):
+    """
+    Transcode `input_path` to an MP3 file at `output_path` using ffmpeg. Defined
+    at module level so it can run in a process pool. Returns the durations (in
+    seconds) of the input and output files.
+    """
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-v", "error", "-i", input_path,
+            "-vn", "-map_metadata", "-1",
+            "-codec:a", "libmp3lame", "-b:a", bitrate, "-ac", str(channels), "-ar", str(sample_rate),
+            "-f", "mp3", output_path,
+        ],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    return get_audio_duration(input_path), get_audio_duration(output_path)
+
+
+class AudioTranscoder(object):
+    """
+    Transcodes audio files to a low bitrate MP3 profile using ffmpeg on a pool
+    of `max_workers` processes. Results are cached on disk by the hash of the
+    input file and the profile. The audio is not trimmed or sped up, so the
+    word timings in `time_object` stay valid; transcodes whose duration differs
+    from the input by more than AUDIO_SYNC_TOLERANCE, or that are not smaller
+    than the input, are discarded and the input file is used as is.
+    """
+
+    def __init__(self, bitrate=AUDIO_BITRATE, channels=AUDIO_CHANNELS, sample_rate=AUDIO_SAMPLE_RATE,
+                 max_workers=None, cache_dir=TRANSCODED_AUDIO_DIR):
+        if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+            raise RuntimeError("Audio transcoding requires ffmpeg and ffprobe in the PATH")
+        self.bitrate = bitrate
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.cache_dir = cache_dir
+        self.settings_key = get_audio_profile_key(bitrate, channels, sample_rate)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        self._results = {}  # input path --> transcoded path (or input path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def transcode(self, input_path):
+        """
+        Return the path of the transcoded version of the audio at `input_path`.
+        """
+        with self._lock:
+            if input_path not in self._path_locks:
+                self._path_locks[input_path] = threading.Lock()
+            path_lock = self._path_locks[input_path]
+        with path_lock:
+            if input_path not in self._results:
+                self._results[input_path] = self._transcode(input_path)
+            return self._results[input_path]
+
+    def _transcode(self, input_path):
+        hasher = hashlib.sha1()
+        with open(input_path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(MEDIA_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        output_path = os.path.join(self.cache_dir, hasher.hexdigest() + "-" + self.settings_key + ".mp3")
+        # a marker file records inputs that must not be transcoded
+        skip_path = output_path + ".skip"
+        STATS.cache_lookup("transcode_cache", os.path.exists(output_path) or os.path.exists(skip_path))
+        if os.path.exists(skip_path):
+            return input_path
+        if not os.path.exists(output_path):
+            tmp_path = get_temp_path(output_path)
+            try:
+                with STATS.timed("audio_transcode"):
+                    input_duration, output_duration = self.executor.submit(
+                        transcode_audio_file, input_path, tmp_path, self.bitrate, self.channels, self.sample_rate
+                    ).result()
+            except (subprocess.CalledProcessError, ValueError) as e:
+                LOGGER.warning("Cannot transcode audio " + input_path + ": " + str(e))
+                record_failed_node(path=input_path, reason="audio transcode failed: " + str(e))
+                return input_path
+            if abs(output_duration - input_duration) > AUDIO_SYNC_TOLERANCE:
+                LOGGER.warning("Transcoded audio %s changed duration from %.2fs to %.2fs; using the original" % (
+                    input_path, input_duration, output_duration
+                ))
+                record_failed_node(path=input_path, reason="audio transcode changed the duration")
+                os.remove(tmp_path)
+                open(skip_path, "w").close()
+                return input_path
+            os.replace(tmp_path, output_path)
+        input_size, output_size = os.path.getsize(input_path), os.path.getsize(output_path)
+        if output_size >= input_size:
+            return input_path
+        STATS.count("audio_transcode.bytes_saved", input_size - output_size)
+        return output_path
+
+
+# NODE CLASSES
+################################################################################
+# Compact, slotted representation of the nodes built by the transform functions.
+# Fields that are the same for all nodes of a class (kind, language, license)
+# are class attributes shared by all instances, and `FIELDS` lists the keys of
+# the ricecooker json dict, in order. Nodes are converted to dicts only when
+# they are written, using `to_json_value`.
+
+def to_json_value(value):
+    """
+    Return the json-serializable version of `value`, which can be a `Node`, a
+    list or tuple of nodes, or a plain value.
+    """
+    if isinstance(value, Node):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(child) for child in value]
+    return value
+
+
+class Node(object):
+    __slots__ = ()
+    FIELDS = ()
+
+    def to_dict(self):
+        return {field: to_json_value(getattr(self, field)) for field in self.FIELDS}
+
+
+class TopicNode(Node):
+    __slots__ = ("source_id", "title", "children")
+    FIELDS = ("kind", "source_id", "title", "language", "children")
+    kind = content_kinds.TOPIC
+    language = KAMKALIMA_LANGUAGE
+
+    def __init__(self, source_id, title, children=None):
+        self.source_id = source_id
+        self.title = title
+        self.children = children if children is not None else []
+
+
+class FileNode(Node):
+    __slots__ = ("file_type", "path", "preset")
+    language = KAMKALIMA_LANGUAGE
+
+    def __init__(self, file_type, path, preset=None):
+        self.file_type = file_type
+        self.path = path
+        self.preset = preset
+
+    def to_dict(self):
+        file_dict = dict(file_type=self.file_type, path=self.path, language=self.language)
+        if self.preset is not None:
+            file_dict["preset"] = self.preset
+        return file_dict
+
+
+class ContentNode(Node):
+    __slots__ = ("source_id", "title", "description", "author", "thumbnail", "files")
+    FIELDS = ("kind", "source_id", "title", "description", "language", "license", "author", "thumbnail", "files")
+    language = KAMKALIMA_LANGUAGE
+
+    def __init__(self, source_id, title, description, author, thumbnail, files):
+        self.source_id = source_id
+        self.title = title
+        self.description = description
+        self.author = author
+        self.thumbnail = thumbnail
+        self.files = files
+
+    @property
+    def license(self):
+        return get_kamkalima_license()
+
+
+class AudioNode(ContentNode):
+    __slots__ = ()
+    kind = content_kinds.AUDIO
+
+
+class Html5Node(ContentNode):
+    __slots__ = ()
+    kind = content_kinds.HTML5
+
+
+class ExerciseNode(Node):
+    __slots__ = ("title", "source_id", "questions")
+    FIELDS = (
+        "kind", "title", "author", "source_id", "description", "language", "license", "exercise_data", "questions"
+    )
+    kind = content_kinds.EXERCISE
+    author = "Kamkalima"
+    description = ""
+    language = KAMKALIMA_LANGUAGE
+
+    def __init__(self, title, source_id, questions):
+        self.title = title
+        self.source_id = source_id
+        self.questions = questions
+
+    @property
+    def license(self):
+        return get_kamkalima_license()
+
+    @property
+    def exercise_data(self):
+        return {
+            "mastery_model": exercises.M_OF_N,
+            "randomize": False,
+            # require 3 correct answers to count as mastery, or all if there are less questions
+            "m": min(3, len(self.questions)),
+        }
+
+
+class SingleSelectionQuestion(Node):
+    __slots__ = ("id", "question", "correct_answer", "all_answers")
+    FIELDS = ("question_type", "id", "question", "correct_answer", "all_answers", "hints")
+    question_type = exercises.SINGLE_SELECTION
+    hints = ()
+
+    def __init__(self, id, question, correct_answer, all_answers):
+        self.id = id
+        self.question = question
+        self.correct_answer = correct_answer
+        self.all_answers = all_answers
+
+
 # TRANSFORM FUNCTIONS
 ################################################################################
 
@@ -117,156 +1507,367 @@ EXERCISE_CATEGORY_LOOKUP = {
 
 
 def exercise_from_kamkalima_questions_list(item_id, category, exercise_questions):
-    exercise_title = EXERCISE_CATEGORY_LOOKUP[category]
-    # Exercise node
-    exercise_dict = dict(
-        kind=content_kinds.EXERCISE,
-        title=exercise_title,
-        author="Kamkalima",
-        source_id=str(item_id) + ":" + category,
-        description="",
-        language=getlang("ar").code,
-        license=KAMKALIMA_LICENSE,
-        exercise_data={
-            "mastery_model": exercises.M_OF_N,
-            "randomize": False,
-            "m": 3,  # By default require 3 to count as mastery
-        },
-        # thumbnail=
-        questions=[],
-    )
     # Add questions to exercise node
     questions = []
     for exercise_question in exercise_questions:
-        question_dict = dict(
-            question_type=exercises.SINGLE_SELECTION,
+        question = SingleSelectionQuestion(
             id=str(exercise_question["id"]),
-            question=exercise_question["title"],
+            question=sys.intern(exercise_question["title"]),
             correct_answer=None,
             all_answers=[],
-            hints=[],
         )
-        # Add answers to question
+        # Add answers to question; answer texts repeat a lot across questions
+        # so they are interned
+        seen_answers = set()
         for answer in exercise_question["answers"]:
-            answer_text = answer["title"]
-            if answer_text not in question_dict["all_answers"]:
-                question_dict["all_answers"].append(answer_text)
+            answer_text = sys.intern(answer["title"])
+            if answer_text not in seen_answers:
+                seen_answers.add(answer_text)
+                question.all_answers.append(answer_text)
                 if answer["is_correct"]:
-                    question_dict["correct_answer"] = answer_text
+                    question.correct_answer = answer_text
             else:
-                LOGGER.warning("Duplicate answer in id=" + question_dict["id"])
-        questions.append(question_dict)
-    exercise_dict["questions"] = questions
-    # Update m in case less than 3 quesitons in the exercise
-    if len(questions) < 3:
-        exercise_dict["exercise_data"]["m"] = len(questions)
-    return exercise_dict
+                LOGGER.warning("Duplicate answer in id=" + question.id)
+        questions.append(question)
+    return ExerciseNode(
+        title=EXERCISE_CATEGORY_LOOKUP[category],
+        source_id=str(item_id) + ":" + category,
+        questions=questions,
+    )
 
 
-def group_by_theme(items):
-    items_by_theme = defaultdict(list)
-    for item in items:
-        themes = item["themes"]
-        for theme in themes:
-            theme_name = theme["name"]
-            items_by_theme[theme_name].append(item)
-    return items_by_theme
-    
-
-# def filter_by_theme(items_by_grade):
-#     filtered_by_theme = defaultdict(list)
-#     for grade in items_by_grade:
-
-
-def group_items_by_grade_and_theme(items):
-    grade_key = {
-        4 : "صف ٤-٦",
-        7 : "صف ٧-٩",
-        10 : "صف ١٠-١٢"
-    }
+GRADE_KEY = {
+    4 : "صف ٤-٦",
+    7 : "صف ٧-٩",
+    10 : "صف ١٠-١٢"
+}
+GRADE_ORDER = ["صف ٤-٦", "صف ٧-٩", "صف ١٠-١٢"]
+
+# Top-level topics of the channel, one per item type
+CHANNEL_SECTIONS = [
+    dict(item_type="text", source_id="reading_comprehension", title="دراسة نص"),
+    dict(item_type="audio", source_id="listening_comprehension", title="إصغاء"),
+]
+
+# Shards of a sharded build, one per (section, grade), in the canonical order of
+# the channel tree. Each item belongs to exactly one shard.
+CHANNEL_SHARDS = [
+    dict(shard_id=section["source_id"] + "-" + str(min_level), section=section, grade_level=grade_level)
+    for section in CHANNEL_SECTIONS
+    for min_level, grade_level in GRADE_KEY.items()
+]
+
+
+def get_item_shard_id(item_type, item):
+    for shard in CHANNEL_SHARDS:
+        if shard["section"]["item_type"] == item_type and shard["grade_level"] == GRADE_KEY[item["min_level"]]:
+            return shard["shard_id"]
+    raise ValueError("unrecognized item_type " + item_type)
+
+
+def get_section_topic_dict(section):
+    return dict(
+        kind = content_kinds.TOPIC,
+        source_id = section["source_id"],
+        title = section["title"],
+    )
 
-    items_by_grade_and_theme = defaultdict(list)
-    for item in items:
-        min_level = item["min_level"]
-        grade_level = grade_key[min_level]
-        if grade_level not in items_by_grade_and_theme.keys():
-            items_by_grade_and_theme[grade_level] = defaultdict(list)
-        themes = item["themes"]
-        for theme in themes:
-            theme_name = theme["name"]
-            items_by_grade_and_theme[grade_level][theme_name].append(item)
-    return items_by_grade_and_theme
-        
-        
 
-def audio_node_from_kamkalima_audio_item(audio_item):
+def get_item_occurrences(item_index):
+    """
+    Return the number of times each `(item_type, item id)` appears in `item_index`.
+    Topic nodes of items listed under several themes are kept only until their
+    last occurrence has been written.
+    """
+    item_occurrences = defaultdict(int)
+    for (item_type, _, _), items in item_index.items():
+        for item in items:
+            item_occurrences[(item_type, str(item["id"]))] += 1
+    return item_occurrences
+
+
+def build_item_index(all_texts_items, all_audios_items):
+    """
+    Group text and audio items by (item_type, grade_level, theme) in a single
+    pass. Returns a dict `{(item_type, grade_level, theme_name): [items]}` whose
+    keys are ordered by channel section, then grade, then by the order in which
+    themes first appear in the API results.
+    """
+    items_by_key = defaultdict(list)
+    for item_type, items in [("text", all_texts_items), ("audio", all_audios_items)]:
+        for item in items:
+            grade_level = GRADE_KEY[item["min_level"]]
+            for theme in item["themes"]:
+                items_by_key[(item_type, grade_level, theme["name"])].append(item)
+
+    section_order = [section["item_type"] for section in CHANNEL_SECTIONS]
+    first_seen = {key: position for position, key in enumerate(items_by_key)}
+    sort_key = lambda key: (section_order.index(key[0]), GRADE_ORDER.index(key[1]), first_seen[key])
+    return {key: items_by_key[key] for key in sorted(items_by_key, key=sort_key)}
+
+
+def audio_node_from_kamkalima_audio_item(audio_item, audio_filenames=None, thumbnails=None):
     if not audio_item["audio"]:
         LOGGER.error('No audio URL for audio id=' + str(audio_item['id']) + '  with title=' + audio_item['title'])
+        record_failed_node(
+            id=audio_item["id"],
+            title=audio_item["title"],
+            item_type="audio",
+            reason="no audio url",
+        )
         return None
-    audio_node = dict(
-        kind=content_kinds.AUDIO,
+    audio_path = audio_item["audio"]
+    if audio_filenames is not None and audio_path in audio_filenames:
+        audio_path = get_storage_path(audio_filenames[audio_path])
+    audio_node = AudioNode(
         source_id=str(audio_item["id"]),
         title=audio_item["title"],
         description=audio_item["excerpt"],
-        language=getlang("ar").code,
-        license=KAMKALIMA_LICENSE,
         author=audio_item["author"]["name"],
         # aggregator
         # provider
-        thumbnail=audio_item["image"],
-        files=[
-            {
-                "file_type": file_types.AUDIO,
-                "path": audio_item["audio"],
-                "language": getlang("ar").code, 
-            }
-        ],
+        thumbnail=(thumbnails or {}).get(audio_item["image"], audio_item["image"]),
+        files=[FileNode(file_types.AUDIO, audio_path)],
     )
     return audio_node
 
 
-def make_html5zip_from_text_item(text_item):
+HTML5APP_INDEX_TEMPLATE_PATH = os.path.join(HTML5APP_TEMPLATE, "index.template.html")
+HTML5APP_STYLES_PATH = os.path.join(HTML5APP_TEMPLATE, "css/styles.css")
+HTML5APP_SCRIPT_PATH = os.path.join(HTML5APP_TEMPLATE, "text-highlighter-script.js")
+# All entries in the zips get the same timestamp so identical inputs produce
+# byte-identical zips (and Studio can skip re-uploading unchanged files)
+HTML5ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def minify_html(html):
+    """
+    Remove the comments, indentation and line breaks between tags of the
+    HTML5 app template (the text item content is inserted after this).
+    """
+    html = re.sub(r"<!--.*?-->", "", html, flags=re.DOTALL)
+    html = re.sub(r"\s*\n\s*", "\n", html).strip()
+    return re.sub(r"(>|%\})\n|\n(?=<|\{%)", r"\1", html)
+
+
+def minify_css(css):
+    """
+    Remove the comments and unneeded whitespace from a stylesheet.
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
+
+
+def get_time_table(time_object):
+    """
+    Convert the `time_object` of a text item, `{word_id: {"start": s, "end": e}}`
+    in seconds, into the compact timing table used by the highlighter: words
+    sorted by start time, with times in milliseconds and delta-encoded.
+
+        {"s": [start - previous start, ...], "d": [end - start, ...],
+         "i": [word id - previous word id, ...]}
+
+    When the word ids are not all integers written without leading zeros (e.g.
+    "007"), they are listed as is in "k" instead of "i". Entries without a start
+    and end time are skipped, and a `time_object` that is not a dict (the API
+    encodes an empty one as `[]`) gives an empty table.
+    """
+    if not isinstance(time_object, dict):
+        time_object = {}
+    words = []
+    for word_id, timing in time_object.items():
+        if not isinstance(timing, dict) or timing.get("start") is None or timing.get("end") is None:
+            continue
+        start = int(round(float(timing["start"]) * 1000))
+        end = int(round(float(timing["end"]) * 1000))
+        words.append((start, max(end - start, 0), str(word_id)))
+    words.sort(key=lambda word: (word[0], word[1]))
+    time_table = {"s": [], "d": []}
+    previous_start = 0
+    for start, duration, _ in words:
+        time_table["s"].append(start - previous_start)
+        time_table["d"].append(duration)
+        previous_start = start
+    word_ids = [word_id for _, _, word_id in words]
+    if all(is_canonical_int(word_id) for word_id in word_ids):
+        time_table["i"] = []
+        previous_id = 0
+        for word_id in map(int, word_ids):
+            time_table["i"].append(word_id - previous_id)
+            previous_id = word_id
+    else:
+        time_table["k"] = word_ids
+    return time_table
+
+
+def is_canonical_int(value):
+    """
+    Return True if the string `value` is exactly `str(int(value))`.
+    """
+    try:
+        return str(int(value)) == value
+    except ValueError:
+        return False
+
+
+class Html5AppRenderer(object):
+    """
+    Renders the HTML5 app for text items. The CSS and JS assets are read only
+    once, when the renderer is created, and the template is compiled the first
+    time it is rendered (so the digest doesn't need jinja2). The template and
+    the CSS are minified.
+    """
+
+    def __init__(self):
+        with open(HTML5APP_INDEX_TEMPLATE_PATH, "rb") as template_file:
+            template_bytes = minify_html(template_file.read().decode("utf-8")).encode("utf-8")
+        with open(HTML5APP_STYLES_PATH, "rb") as styles_file:
+            self.styles = minify_css(styles_file.read().decode("utf-8")).encode("utf-8")
+        with open(HTML5APP_SCRIPT_PATH, "rb") as script_file:
+            self.script = script_file.read()
+        self.template_source = template_bytes.decode("utf-8")
+        self._template = None
+        self._template_lock = threading.Lock()
+        # the digest covers the minified assets, i.e. exactly what goes in the zips
+        hasher = hashlib.sha1()
+        for asset_bytes in [template_bytes, self.styles, self.script]:
+            hasher.update(hashlib.sha1(asset_bytes).digest())
+        self.digest = hasher.hexdigest()
+
+    def render_index(self, **kwargs):
+        with self._template_lock:
+            if self._template is None:
+                from jinja2 import Template
+                self._template = Template(self.template_source)
+        return self._template.render(**kwargs)
+
+    def write_zip(self, zip_path, index_html, splash_image_path=None):
+        """
+        Write the zip deterministically: fixed entry order, timestamps and
+        permissions. The zip is written to a temporary file and then moved to
+        `zip_path` so interrupted runs don't leave truncated zips behind.
+        """
+        entries = [
+            ("index.html", index_html.encode("utf-8")),
+            ("text-highlighter-script.js", self.script),
+            ("css/styles.css", self.styles),
+        ]
+        tmp_path = get_temp_path(zip_path)
+        with zipfile.ZipFile(tmp_path, "w") as zipper:
+            for entry_name, entry_bytes in entries:
+                zipper.writestr(self._get_zipinfo(entry_name), entry_bytes)
+            if splash_image_path:
+                info = self._get_zipinfo("img/splash.jpg")
+                with open(splash_image_path, "rb") as src, zipper.open(info, "w") as dest:
+                    shutil.copyfileobj(src, dest)
+        os.replace(tmp_path, zip_path)
+
+    def _get_zipinfo(self, entry_name):
+        info = zipfile.ZipInfo(entry_name, date_time=HTML5ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        return info
+
+
+_HTML5APP_RENDERER = None
+_HTML5APP_RENDERER_LOCK = threading.Lock()
+
+def get_html5app_renderer():
+    """
+    Return the process-wide `Html5AppRenderer`, creating it on first use.
+    """
+    global _HTML5APP_RENDERER
+    with _HTML5APP_RENDERER_LOCK:
+        if _HTML5APP_RENDERER is None:
+            _HTML5APP_RENDERER = Html5AppRenderer()
+        return _HTML5APP_RENDERER
+
+
+def get_html5app_template_digest():
+    """
+    Return a digest of the template, CSS and JS files used to build the zips.
+    """
+    return get_html5app_renderer().digest
+
+
+def get_text_item_digest(text_item, template_digest, audio_href="", image_digest=None):
+    """
+    Return a digest of the `text_item` fields rendered in its HTML5 zip, plus
+    the `template_digest` of the assets and the `image_digest` of the content
+    of the splash image, so the zip is rebuilt when any of them changes.
+    """
+    rendered_fields = dict(
+        title=text_item["title"],
+        body=text_item["body"],
+        excerpt=text_item["excerpt"],
+        author=text_item["author"]["name"],
+        time_object=text_item["time_object"],
+        image=text_item.get("image"),
+        image_digest=image_digest,
+        audio=text_item["audio"],
+        audio_href=audio_href,
+        template=template_digest,
+    )
+    serialized = json.dumps(rendered_fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def get_html5zip_path(text_item, digest):
+    return os.path.join(HTML5APP_ZIPS_LOCAL_DIR, str(text_item["id"]) + "-" + digest[:16] + ".zip")
+
+
+def make_html5zip_from_text_item(text_item, template_digest=None, media_cache=None, audio_filenames=None,
+                                 image_optimizer=None):
     id_str = str(text_item["id"])
-    zip_path = os.path.join(HTML5APP_ZIPS_LOCAL_DIR, id_str + ".zip")
+    if template_digest is None:
+        template_digest = get_html5app_template_digest()
+    if image_optimizer is not None:
+        template_digest += ":" + image_optimizer.settings_key
 
     # check for audio element
     show_audio_element = False
     audio_href = ''
-    audio_file = None
+    audio_filename = None
     if text_item['audio']:
         show_audio_element = True
-        audio_file = AudioFile(path = text_item["audio"], preset = format_presets.AUDIO_DEPENDENCY)
-        audio_filename = audio_file.get_filename()
+        audio_filename = get_audio_filename(text_item["audio"], audio_filenames)
         first_char_filename = audio_filename[0]
         second_char_filename = audio_filename[1]
         audio_href = "../../storage/{}/{}/{}".format(first_char_filename, second_char_filename, audio_filename)
 
+    # the splash image is revalidated first: a new image at the same url changes the zip
+    splash_image_path = None
+    image_digest = None
+    if text_item.get("image"):
+        if media_cache is None:
+            media_cache = MediaCache()
+        splash_image_path = media_cache.get(text_item["image"], category="image")
+        image_digest = media_cache.get_digest(text_item["image"], category="image")
+
+    digest = get_text_item_digest(text_item, template_digest, audio_href=audio_href, image_digest=image_digest)
+    zip_path = get_html5zip_path(text_item, digest)
     if os.path.exists(zip_path):
         LOGGER.debug("Found existing zip at " + zip_path)
-        return zip_path, audio_file
+        STATS.cache_lookup("zip_cache", True)
+        return zip_path, audio_filename
     else:
         LOGGER.debug("Creating zip from text_item id=" + str(text_item['id']))
-
-    # load template
-    template_path = os.path.join(HTML5APP_TEMPLATE, "index.template.html")
-    script_highlighter_path = os.path.join(HTML5APP_TEMPLATE, "text-highlighter-script.js")
-    template_src = open(template_path).read()
-    template = Template(template_src)
+        STATS.cache_lookup("zip_cache", False)
 
     # extract properties
-    time_object = json.loads(text_item['time_object'])
+    time_table = get_time_table(json.loads(text_item['time_object']) if text_item['time_object'] else {})
     title = text_item["title"]
     content = text_item["body"]
-    author=text_item["author"]["name"],
+    author = text_item["author"]["name"]
     description = text_item["excerpt"]
-    if "image" in text_item:
-        splash_image_url = text_item["image"]
-        show_splash_image = True
-    else:
-        show_splash_image = False
+    show_splash_image = splash_image_path is not None
 
     # render template to string
-    index_html = template.render(
+    renderer = get_html5app_renderer()
+    index_html = renderer.render_index(
         title=title,
         content=content,
         author=author,
@@ -274,89 +1875,272 @@ def make_html5zip_from_text_item(text_item):
         show_splash_image=show_splash_image,
         show_audio_element = show_audio_element,
         audio_href = audio_href,
-        time_object=time_object
+        # escape "</" so the table can't close the inline <script> element
+        time_table=json.dumps(time_table, separators=(",", ":")).replace("</", "<\\/"),
     )
 
     # save to zip file
-    with HTMLWriter(zip_path, "w") as zipper:
-        # index.html
-        zipper.write_index_contents(index_html)
-        zipper.write_file(script_highlighter_path,filename='text-highlighter-script.js')
-        # css/styles.css
-        with open(os.path.join(HTML5APP_TEMPLATE, "css/styles.css")) as stylesf:
-            zipper.write_contents("styles.css", stylesf.read(), directory="css/")
-        if show_splash_image:
-            # img/splash.jpg
-            resp = requests.get(splash_image_url)
-            zipper.write_contents("splash.jpg", resp.content, directory="img/")
-        else:
-            LOGGER.warning("zip with id " + id_str + " has no splash image")
+    if show_splash_image:
+        if image_optimizer is not None:
+            splash_image_path, _, _ = image_optimizer.optimize(splash_image_path)
+    else:
+        LOGGER.warning("zip with id " + id_str + " has no splash image")
+    with STATS.timed("zip_write"):
+        renderer.write_zip(zip_path, index_html, splash_image_path=splash_image_path)
 
-    return zip_path, audio_file
+    return zip_path, audio_filename
 
 
-def html5_node_from_kamkalima_text_item(text_item):
-    zip_path, audio_file = make_html5zip_from_text_item(text_item)
-    print(zip_path)
-    files=[
-        {
-            "file_type": file_types.HTML5,
-            "path": zip_path,
-            "language": getlang("ar").code,
-        },
-    ]
-    # add audio_file to files if exists
-    if audio_file is not None:
-        audio_path = config.get_storage_path(audio_file.get_filename())
-        files.append(
-            {
-                "file_type": file_types.AUDIO,
-                "path": audio_path,
-                "language": getlang("ar").code,
-                "preset": format_presets.AUDIO_DEPENDENCY
-            }
+def remove_all_html5zips():
+    """
+    Delete all the zips in `HTML5APP_ZIPS_LOCAL_DIR`, so they are rebuilt.
+    """
+    if not os.path.exists(HTML5APP_ZIPS_LOCAL_DIR):
+        return
+    LOGGER.info("Deleting all zips in cache dir {}".format(HTML5APP_ZIPS_LOCAL_DIR))
+    for zip_file in os.listdir(HTML5APP_ZIPS_LOCAL_DIR):
+        zip_file_abs_path = os.path.join(HTML5APP_ZIPS_LOCAL_DIR, zip_file)
+        if zip_file_abs_path.endswith(".zip"):
+            os.remove(zip_file_abs_path)
+
+
+def remove_orphaned_html5zips(html5zips, keep_zip_paths=()):
+    """
+    Delete the zips in `HTML5APP_ZIPS_LOCAL_DIR` that are not used by `html5zips`
+    or listed in `keep_zip_paths`, i.e. zips of removed text items and zips
+    built from outdated content.
+    """
+    used_zip_paths = set(os.path.abspath(zip_path) for zip_path, _ in html5zips.values())
+    used_zip_paths.update(os.path.abspath(zip_path) for zip_path in keep_zip_paths)
+    for zip_file in os.listdir(HTML5APP_ZIPS_LOCAL_DIR):
+        zip_file_abs_path = os.path.abspath(os.path.join(HTML5APP_ZIPS_LOCAL_DIR, zip_file))
+        if zip_file.endswith(".zip") and zip_file_abs_path not in used_zip_paths:
+            LOGGER.debug("Removing orphaned zip " + zip_file_abs_path)
+            os.remove(zip_file_abs_path)
+
+
+class MediaPipeline(object):
+    """
+    Prepares the media of items as soon as they are fetched from the API, while
+    later pages are still downloading: audio files are prefetched into storage
+    on one pool of `audio_workers` threads and the HTML5 zips of text items are
+    built on another pool of `zip_workers` threads. Thumbnails are deduplicated
+    by URL and copied into storage on a third pool of `image_workers` threads;
+    they share the media cache with the splash images of the zips. When an
+    `image_optimizer` is given, thumbnails and splash images are optimized.
+    Audio files are transcoded by `audio_transcoder` if given. Items that are
+    unchanged since the last run according to `item_manifest` are skipped.
+    At most `max_pending_zips` zips are queued at a time; `submit` waits for
+    a slot, so text items should be `StoredItem`s whose body and word timings
+    are only read by the zip worker.
+    Call `get_results` once all items have been submitted to obtain
+    `(audio_filenames, html5zips, thumbnails)`: the storage filenames of the
+    audio files by url, `{text_item_id: (zip_path, audio_filename)}` and the
+    storage paths of the thumbnails by url.
+    """
+
+    def __init__(self, media_cache, audio_workers=AUDIO_PREFETCH_WORKERS, zip_workers=ZIP_BUILD_WORKERS,
+                 item_manifest=None, image_optimizer=None, image_workers=IMAGE_WORKERS, audio_transcoder=None,
+                 max_pending_zips=None):
+        self.media_cache = media_cache
+        self.audio_transcoder = audio_transcoder
+        self.item_manifest = item_manifest
+        self.image_optimizer = image_optimizer
+        self.image_executor = ThreadPoolExecutor(max_workers=image_workers)
+        self.thumbnail_futures = {}  # image_url --> future (storage path, original size, optimized size)
+        self.item_image_urls = {}  # item_type:id --> image_url
+        self.template_digest = get_html5app_template_digest()
+        self.audio_executor = ThreadPoolExecutor(max_workers=audio_workers)
+        self.zip_executor = ThreadPoolExecutor(max_workers=zip_workers)
+        self.zip_slots = threading.BoundedSemaphore(max_pending_zips or 2 * zip_workers)
+        self.audio_futures = {}  # audio_url --> future storage filename
+        self.zip_futures = {}  # text item id --> future (zip_path, audio_filename)
+        os.makedirs(HTML5APP_ZIPS_LOCAL_DIR, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for executor in [self.zip_executor, self.audio_executor, self.image_executor]:
+            executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def submit(self, item_type, item):
+        if self.item_manifest is not None and self.item_manifest.is_unchanged(item_type, item):
+            return  # the subtree from the previous run will be reused
+        audio_url = item.get("audio")
+        if audio_url and audio_url not in self.audio_futures:
+            self.audio_futures[audio_url] = self.audio_executor.submit(
+                STATS.profiled(prefetch_audio_file), audio_url, self.media_cache, self.audio_transcoder
+            )
+        if item_type == "text" and str(item["id"]) not in self.zip_futures:
+            self.zip_slots.acquire()
+            zip_future = self.zip_executor.submit(STATS.profiled(self._build_html5zip), item)
+            zip_future.add_done_callback(lambda future: self.zip_slots.release())
+            self.zip_futures[str(item["id"])] = zip_future
+        image_url = item.get("image")
+        if image_url:
+            self.item_image_urls[item_type + ":" + str(item["id"])] = image_url
+            if image_url not in self.thumbnail_futures:
+                self.thumbnail_futures[image_url] = self.image_executor.submit(
+                    STATS.profiled(self._prepare_thumbnail), image_url
+                )
+
+    def _prepare_thumbnail(self, image_url):
+        """
+        Copy the (optimized) image at `image_url` into storage. Returns its
+        storage path, or None if it could not be downloaded, in which case the
+        node keeps the remote thumbnail url.
+        """
+        import requests
+        try:
+            image_path = self.media_cache.get(image_url, category="image")
+        except (requests.RequestException, RuntimeError) as e:
+            LOGGER.warning("Cannot download thumbnail " + image_url + ": " + str(e))
+            record_failed_node(url=image_url, reason="thumbnail download failed: " + str(e))
+            return None, 0, 0
+        original_size = optimized_size = os.path.getsize(image_path)
+        if self.image_optimizer is not None:
+            image_path, original_size, optimized_size = self.image_optimizer.optimize(image_path)
+        storage_path = get_storage_path(copy_to_storage(image_path, default_ext="jpg"))
+        return storage_path, original_size, optimized_size
+
+    def _build_html5zip(self, text_item):
+        audio_filenames = {}
+        if text_item["audio"]:
+            audio_filenames[text_item["audio"]] = self.audio_futures[text_item["audio"]].result()
+        return make_html5zip_from_text_item(
+            text_item, self.template_digest, self.media_cache, audio_filenames,
+            image_optimizer=self.image_optimizer,
         )
 
-    html5_node = dict(
-        kind=content_kinds.HTML5,
+    def get_results(self):
+        audio_filenames = {url: future.result() for url, future in self.audio_futures.items()}
+        html5zips = {id_str: future.result() for id_str, future in self.zip_futures.items()}
+        thumbnails = {}
+        bytes_saved_per_item = {}
+        for item_key, image_url in self.item_image_urls.items():
+            storage_path, original_size, optimized_size = self.thumbnail_futures[image_url].result()
+            if storage_path is not None:
+                thumbnails[image_url] = storage_path
+            bytes_saved_per_item[item_key] = original_size - optimized_size
+        if self.image_optimizer is not None and bytes_saved_per_item:
+            LOGGER.info("Image optimization saved %s bytes per item on average" % (
+                sum(bytes_saved_per_item.values()) // max(len(bytes_saved_per_item), 1)
+            ))
+            STATS.count("image_optimization.bytes_saved", sum(bytes_saved_per_item.values()))
+            STATS.set_info("image_bytes_saved_per_item", bytes_saved_per_item)
+        return audio_filenames, html5zips, thumbnails
+
+
+def fetch_and_prepare_items(access_token, media_pipeline, item_store, page_workers=PAGE_FETCH_WORKERS,
+                            cache=None, include_item=None):
+    """
+    Fetch the texts and audios endpoints concurrently, save every item to
+    `item_store` in API order as soon as its page arrives and pass the stored
+    item to `media_pipeline`. If `include_item(item_type, item)` is given,
+    only the items for which it returns True are prepared and saved.
+    """
+    endpoints = [("text", API_TEXTS_ENDPOINT), ("audio", API_AUDIOS_ENDPOINT)]
+    num_fetched = {item_type: 0 for item_type, _ in endpoints}
+    # bounded so the fetch threads wait while the media pipeline is busy
+    page_queue = queue.Queue(maxsize=2 * len(endpoints))
+    stop_fetching = threading.Event()
+
+    def put_page(page):
+        while not stop_fetching.is_set():
+            try:
+                page_queue.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_pages(item_type, endpoint):
+        try:
+            for items in iter_item_pages(endpoint, access_token, max_workers=page_workers, cache=cache):
+                if not put_page((item_type, items)):
+                    return
+        finally:
+            put_page((item_type, None))  # end of pages for this endpoint
+
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as fetch_executor:
+        fetch_futures = [
+            fetch_executor.submit(STATS.profiled(fetch_pages), item_type, endpoint)
+            for item_type, endpoint in endpoints
+        ]
+        num_finished = 0
+        try:
+            while num_finished < len(endpoints):
+                item_type, items = page_queue.get()
+                if items is None:
+                    num_finished += 1
+                    continue
+                num_fetched[item_type] += len(items)
+                if include_item is not None:
+                    items = [item for item in items if include_item(item_type, item)]
+                for item in item_store.add_items(item_type, items):
+                    media_pipeline.submit(item_type, item)
+        except BaseException:
+            stop_fetching.set()  # don't leave the fetch threads waiting on a full queue
+            raise
+        for fetch_future in fetch_futures:
+            fetch_future.result()  # re-raise errors from the fetch threads
+
+    for item_type, endpoint in endpoints:
+        if not num_fetched[item_type]:
+            raise RuntimeError("Kamkalima API not accessible or 0 items returned from " + endpoint)
+        LOGGER.info("  Found %s %s items" % (num_fetched[item_type], item_type))
+
+
+def html5_node_from_kamkalima_text_item(text_item, html5zips=None, thumbnails=None):
+    if html5zips is not None and str(text_item["id"]) in html5zips:
+        zip_path, audio_filename = html5zips[str(text_item["id"])]
+    else:
+        zip_path, audio_filename = make_html5zip_from_text_item(text_item)
+    files = [FileNode(file_types.HTML5, zip_path)]
+    # add audio_file to files if exists
+    if audio_filename is not None:
+        audio_path = get_storage_path(audio_filename)
+        files.append(FileNode(file_types.AUDIO, audio_path, preset=format_presets.AUDIO_DEPENDENCY))
+
+    html5_node = Html5Node(
         source_id=str(text_item["id"]),
         title=text_item["title"],
         description=text_item["excerpt"],
-        language=getlang("ar").code,
-        license=KAMKALIMA_LICENSE,
         author=text_item["author"]["name"],
         # aggregator
         # provider
-        thumbnail=text_item["image"],
+        thumbnail=(thumbnails or {}).get(text_item["image"], text_item["image"]),
         files= files
     )
     return html5_node
 
 
-def topic_node_from_item(item_type, item):
+def topic_node_from_item(item_type, item, html5zips=None, audio_filenames=None, thumbnails=None):
     """
     In order to keep the audios and texts close to their associated exercises,
     we'll store each item as a topic node.
     `item_type` is either `audio` or `text`
+    `html5zips`, `audio_filenames` and `thumbnails` are the prebuilt zips and
+    the local copies of the media returned by `MediaPipeline.get_results`.
     """
-    topic_node = dict(
-        kind=content_kinds.TOPIC,
+    topic_node = TopicNode(
         source_id=str(item["id"]) + ":" + "container",
         title=item["title"],
         # description=item['excerpt'],
-        language=getlang("ar").code,
-        children=[],
     )
 
     # Add content node
     if item_type == "audio":
-        audio_node = audio_node_from_kamkalima_audio_item(item)
+        audio_node = audio_node_from_kamkalima_audio_item(
+            item, audio_filenames=audio_filenames, thumbnails=thumbnails
+        )
         if audio_node:
-            topic_node["children"].append(audio_node)
+            topic_node.children.append(audio_node)
     elif item_type == "text":
-        html5_node = html5_node_from_kamkalima_text_item(item)
+        html5_node = html5_node_from_kamkalima_text_item(item, html5zips=html5zips, thumbnails=thumbnails)
         if html5_node:
-            topic_node["children"].append(html5_node)
+            topic_node.children.append(html5_node)
     else:
         raise ValueError("unrecognized item_type " + item_type)
 
@@ -365,60 +2149,466 @@ def topic_node_from_item(item_type, item):
     for category, exercise_questions in item["questions"].items():
         if len(exercise_questions) < 1:
             LOGGER.info("No exercise questions for exercise id: {}, in category: {}".format(item_id, category))
-            print(item["title"])
-
-            with open(FAILED_NODES_JSON, "w", encoding = "utf-8") as f:
-                dict_failed = {}
-                dict_failed["id"] = item_id
-                dict_failed["title"] = item["title"]
-                dict_failed["category_failed"] = category
-                json.dump(dict_failed, f, indent=2, ensure_ascii=False)
-                continue
-    
+            record_failed_node(
+                id=item_id,
+                title=item["title"],
+                item_type=item_type,
+                category_failed=category,
+                reason="no exercise questions",
+            )
+            continue
 
         exercise_node = exercise_from_kamkalima_questions_list(
             item_id, category, exercise_questions
         )
-        topic_node["children"].append(exercise_node)
+        topic_node.children.append(exercise_node)
 
         
     return topic_node
 
 
+# DELTA SYNC
+################################################################################
+
+def get_build_digest(template_digest, settings=None):
+    """
+    Return a digest of everything besides the item data that goes into the
+    subtree of an item: the chef code, the HTML5 app assets and the `settings`
+    that affect how nodes are built. Changing any of these invalidates all the
+    subtrees saved by `ItemManifest`.
+    """
+    hasher = hashlib.sha1()
+    with open(os.path.abspath(__file__), "rb") as chef_source:
+        hasher.update(chef_source.read())
+    hasher.update(template_digest.encode("utf-8"))
+    hasher.update(json.dumps(settings or {}, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class ItemManifest(object):
+    """
+    Manifest of `item_type:id --> content fingerprint` of the items included in
+    the last successful run, together with the topic node subtree built for
+    each item (saved in `SUBTREES_DIR`). Items whose fingerprint did not change
+    reuse their previous subtree, which skips downloading their media, building
+    their zip and transforming their exercises. Subtrees are only reused when
+    the `build_digest` is the same as in the last run, but the item changes are
+    always reported against the last run.
+    """
+
+    def __init__(self, build_digest, manifest_path=ITEM_MANIFEST_JSON, subtrees_dir=SUBTREES_DIR):
+        self.build_digest = build_digest
+        self.manifest_path = manifest_path
+        self.subtrees_dir = subtrees_dir
+        self.previous_items = {}
+        self.reuse_subtrees = False
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.previous_items = manifest["items"]
+            self.reuse_subtrees = manifest.get("build_digest") == build_digest
+            if not self.reuse_subtrees:
+                LOGGER.info("Chef code, assets or settings changed: rebuilding all items")
+        self.current_items = {}
+        self.reused_zip_paths = set()
+        self._lock = threading.Lock()
+        self._unchanged = {}  # item key --> decision, so it is the same for all stages
+        os.makedirs(self.subtrees_dir, exist_ok=True)
+
+    def _get_key(self, item_type, item):
+        return item_type + ":" + str(item["id"])
+
+    def get_fingerprint(self, item):
+        return get_item_fingerprint(item)
+
+    def _get_subtree_path(self, key, fingerprint):
+        return os.path.join(self.subtrees_dir, key.replace(":", "-") + "-" + fingerprint[:16] + ".json")
+
+    def is_unchanged(self, item_type, item):
+        """
+        Return True if `item` has the same fingerprint as in the last run and
+        its saved subtree and all the local files it references still exist.
+        """
+        key = self._get_key(item_type, item)
+        with self._lock:
+            if key not in self._unchanged:
+                self._unchanged[key] = self._check_unchanged(key, item)
+            return self._unchanged[key]
+
+    def _check_unchanged(self, key, item):
+        previous = self.previous_items.get(key)
+        if not self.reuse_subtrees or previous is None or previous["fingerprint"] != self.get_fingerprint(item):
+            return False
+        subtree_path = self._get_subtree_path(key, previous["fingerprint"])
+        if not os.path.exists(subtree_path):
+            return False
+        with open(subtree_path, encoding="utf-8") as subtree_file:
+            local_paths = get_local_file_paths(json.load(subtree_file))
+        return all(os.path.exists(path) for path in local_paths)
+
+    def load_subtree(self, item_type, item):
+        """
+        Return the subtree saved for `item` in the last run if it is unchanged,
+        otherwise `None`.
+        """
+        if not self.is_unchanged(item_type, item):
+            return None
+        key = self._get_key(item_type, item)
+        fingerprint = self.previous_items[key]["fingerprint"]
+        with open(self._get_subtree_path(key, fingerprint), encoding="utf-8") as subtree_file:
+            topic_node = json.load(subtree_file)
+        with self._lock:
+            self.current_items[key] = self.previous_items[key]
+            self.reused_zip_paths.update(
+                path for path in get_local_file_paths(topic_node) if path.endswith(".zip")
+            )
+        return topic_node
+
+    def save_subtree(self, item_type, item, topic_node):
+        key = self._get_key(item_type, item)
+        fingerprint = self.get_fingerprint(item)
+        subtree_path = self._get_subtree_path(key, fingerprint)
+        with open(subtree_path + ".tmp", "w", encoding="utf-8") as subtree_file:
+            json.dump(to_json_value(topic_node), subtree_file, ensure_ascii=False)
+        os.replace(subtree_path + ".tmp", subtree_path)
+        with self._lock:
+            self.current_items[key] = dict(fingerprint=fingerprint, updated_at=item.get("updated_at"))
+
+    def get_changes(self):
+        """
+        Return the keys of the items `added`, `changed` and `removed` since the
+        last run, compared to the items included in this run.
+        """
+        added = sorted(key for key in self.current_items if key not in self.previous_items)
+        changed = sorted(
+            key for key in self.current_items
+            if key in self.previous_items
+            and self.current_items[key]["fingerprint"] != self.previous_items[key]["fingerprint"]
+        )
+        removed = sorted(key for key in self.previous_items if key not in self.current_items)
+        return dict(added=added, changed=changed, removed=removed)
+
+    def save(self):
+        """
+        Save the manifest of this run and delete subtrees no longer in use.
+        Call this only once the run completed successfully.
+        """
+        manifest = dict(build_digest=self.build_digest, items=self.current_items)
+        with open(self.manifest_path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        used_subtree_paths = set(
+            os.path.abspath(self._get_subtree_path(key, entry["fingerprint"]))
+            for key, entry in self.current_items.items()
+        )
+        for subtree_file in os.listdir(self.subtrees_dir):
+            subtree_path = os.path.abspath(os.path.join(self.subtrees_dir, subtree_file))
+            if not subtree_file.endswith(".json") or not os.path.isfile(subtree_path):
+                continue  # not a subtree of this manifest
+            if subtree_path not in used_subtree_paths:
+                os.remove(subtree_path)
+
+
+def get_local_file_paths(node):
+    """
+    Return the paths of all the local (not http) files used in the subtree `node`.
+    """
+    local_paths = []
+    for file_dict in node.get("files", []):
+        if not file_dict["path"].startswith(("http://", "https://")):
+            local_paths.append(file_dict["path"])
+    thumbnail = node.get("thumbnail")
+    if thumbnail and not thumbnail.startswith(("http://", "https://")):
+        local_paths.append(thumbnail)
+    for child in node.get("children", []):
+        local_paths.extend(get_local_file_paths(child))
+    return local_paths
+
+
+# JSON TREE WRITER
+################################################################################
+
+class JsonTreeWriter(object):
+    """
+    Writes a ricecooker json tree to `json_tree_path` incrementally, as topic and
+    content nodes are produced, instead of building the whole tree in memory.
+    The output is identical to that of `write_tree_to_json_tree`. Usage:
+
+        with JsonTreeWriter(json_tree_path) as tree_writer:
+            tree_writer.start_topic(channel_dict)
+            tree_writer.start_topic(topic_dict)
+            tree_writer.add_node(content_node)
+            tree_writer.end_topic()
+            tree_writer.end_topic()
+
+    Note `children` are always written as the last key of each topic.
+    """
+
+    INDENT = "  "
+
+    def __init__(self, json_tree_path):
+        self.json_tree_path = json_tree_path
+        self._file = None
+        self._open_topics = []  # [level, number of children written] per open topic
+
+    def __enter__(self):
+        parent_dir, _ = os.path.split(self.json_tree_path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self._file = open(self.json_tree_path + ".tmp", "w", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None:
+            if self._open_topics:
+                raise ValueError("JsonTreeWriter closed with unfinished topics")
+            os.replace(self.json_tree_path + ".tmp", self.json_tree_path)
+        else:
+            os.remove(self.json_tree_path + ".tmp")
+
+    def _dumps(self, value, level):
+        serialized = json.dumps(value, indent=2, ensure_ascii=False)
+        return serialized.replace("\n", "\n" + self.INDENT * level)
+
+    def _start_child(self):
+        """
+        Write the separator before a new child and return the child's level.
+        """
+        if not self._open_topics:
+            return 0
+        parent = self._open_topics[-1]
+        self._file.write("," if parent[1] else "")
+        parent[1] += 1
+        level = parent[0] + 2
+        self._file.write("\n" + self.INDENT * level)
+        return level
+
+    def start_topic(self, topic_node):
+        """
+        Write all the keys of `topic_node` and open its `children` list.
+        """
+        level = self._start_child()
+        self._file.write("{")
+        for key, value in topic_node.items():
+            if key == "children":
+                continue
+            self._file.write("\n" + self.INDENT * (level + 1) + json.dumps(key) + ": ")
+            self._file.write(self._dumps(value, level + 1) + ",")
+        self._file.write("\n" + self.INDENT * (level + 1) + '"children": [')
+        self._open_topics.append([level, 0])
+
+    def add_node(self, node):
+        """
+        Write the complete `node` (content node or subtree, as a `Node` or a
+        dict) to the current topic.
+        """
+        level = self._start_child()
+        self._file.write(self._dumps(to_json_value(node), level))
+
+    def add_serialized_node(self, node_json_path):
+        """
+        Copy the node saved by another `JsonTreeWriter` at `node_json_path` to
+        the current topic, without loading it in memory.
+        """
+        level = self._start_child()
+        with open(node_json_path, encoding="utf-8") as node_file:
+            for line_number, line in enumerate(node_file):
+                self._file.write(line if line_number == 0 else self.INDENT * level + line)
+
+    def end_topic(self):
+        level, num_children = self._open_topics.pop()
+        if num_children:
+            self._file.write("\n" + self.INDENT * (level + 1))
+        self._file.write("]\n" + self.INDENT * level + "}")
+
+
 # CHEF
 ################################################################################
 
 
-class KamkalimaChef(JsonTreeChef):
+def add_chef_arguments(parser):
     """
-    The chef class that takes care of uploading channel to Kolibri Studio.
-    We'll call its `main()` method from the command line script.
+    Add the options of the chef to `parser`, used both by `KamkalimaChef` and by
+    the stage commands.
+    """
+    parser.add_argument(
+        "--page-workers",
+        type=int,
+        default=PAGE_FETCH_WORKERS,
+        help="Maximum number of API pages to fetch concurrently.",
+    )
+    parser.add_argument(
+        "--zip-workers",
+        type=int,
+        default=ZIP_BUILD_WORKERS,
+        help="Number of worker threads used to build the HTML5 zips.",
+    )
+    parser.add_argument(
+        "--audio-workers",
+        type=int,
+        default=AUDIO_PREFETCH_WORKERS,
+        help="Maximum number of audio files downloaded concurrently.",
+    )
+    parser.add_argument(
+        "--image-workers",
+        type=int,
+        default=IMAGE_WORKERS,
+        help="Maximum number of thumbnails downloaded concurrently.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Replay API responses from the local cache without network access.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Save cProfile stats for each stage of the run to " + PROFILES_DIR,
+    )
+    parser.add_argument(
+        "--optimize-images",
+        action="store_true",
+        help="Resize and recompress splash images and thumbnails (requires Pillow).",
+    )
+    parser.add_argument(
+        "--image-max-width",
+        type=int,
+        default=IMAGE_MAX_WIDTH,
+        help="Maximum width of optimized images, in pixels.",
+    )
+    parser.add_argument(
+        "--image-max-height",
+        type=int,
+        default=IMAGE_MAX_HEIGHT,
+        help="Maximum height of optimized images, in pixels.",
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=IMAGE_QUALITY,
+        help="JPEG quality (1-95) of optimized images.",
+    )
+    parser.add_argument(
+        "--transcode-audio",
+        action="store_true",
+        help="Transcode audio files to a low bitrate MP3 profile (requires ffmpeg).",
+    )
+    parser.add_argument(
+        "--audio-bitrate",
+        default=AUDIO_BITRATE,
+        help="Bitrate of transcoded audio files, e.g. 32k.",
+    )
+    parser.add_argument(
+        "--audio-channels",
+        type=int,
+        default=AUDIO_CHANNELS,
+        help="Number of channels of transcoded audio files (1 for mono).",
+    )
+    parser.add_argument(
+        "--audio-sample-rate",
+        type=int,
+        default=AUDIO_SAMPLE_RATE,
+        help="Sample rate (Hz) of transcoded audio files.",
+    )
+    parser.add_argument(
+        "--transcode-workers",
+        type=int,
+        default=None,
+        help="Number of ffmpeg processes run concurrently (default: number of CPUs).",
+    )
+    parser.add_argument(
+        "--shard-workers",
+        type=int,
+        default=0,
+        help="Build the channel in shards (one per section and grade) using this many processes.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard_arg,
+        default=None,
+        help="Only build the shards of machine I of M (e.g. 0/4) into --shard-dir, then exit.",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="Assemble the channel tree from the shards in --shard-dir.",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        default=SHARDS_DIR,
+        help="Directory (shared by all machines) where shards are saved.",
+    )
+
+
+class KamkalimaChannelBuilder(object):
+    """
+    Builds the ricecooker json tree of the channel. This is the part of
+    `KamkalimaChef` that doesn't need ricecooker's chef classes, so that the
+    stage commands (`fetch`, `build-zips` and `build-tree`) can use it alone.
     """
 
     RICECOOKER_JSON_TREE = "kamkalima_ricecooker_json_tree.json"
+    TREES_DATA_DIR = os.path.join("chefdata", "trees")
+
+    def get_json_tree_path(self, *args, **kwargs):
+        return os.path.join(self.TREES_DATA_DIR, self.RICECOOKER_JSON_TREE)
 
-    def pre_run(self, args, options):
+    def fetch_content(self, args):
         """
-        Build the ricecooker json tree for the entire channel.
+        The `fetch` stage: download the API responses into the API cache and
+        the images and audio files of all the items into the media cache, so
+        that the following stages can run offline.
+        """
+        STATS.reset(profile=args["profile"])
+        with STATS.stage("auth"):
+            access_token = get_authentication_token()
+        api_cache = ApiResponseCache()
+        media_urls = {"image": {}, "audio": {}}  # category --> ordered set of urls
+        with STATS.stage("fetch"):
+            for endpoint in [API_TEXTS_ENDPOINT, API_AUDIOS_ENDPOINT]:
+                for items in iter_item_pages(endpoint, access_token, max_workers=args["page_workers"], cache=api_cache):
+                    for item in items:
+                        for category in media_urls:
+                            if item.get(category):
+                                media_urls[category][item[category]] = True
+        LOGGER.info("Downloading %s images and %s audio files" % (
+            len(media_urls["image"]), len(media_urls["audio"])
+        ))
+        media_cache = MediaCache()
+        with STATS.stage("media"):
+            with ThreadPoolExecutor(max_workers=args["image_workers"]) as image_executor, \
+                    ThreadPoolExecutor(max_workers=args["audio_workers"]) as audio_executor:
+                futures = [
+                    executor.submit(STATS.profiled(media_cache.get), url, category)
+                    for category, executor in [("image", image_executor), ("audio", audio_executor)]
+                    for url in media_urls[category]
+                ]
+                for future in futures:
+                    future.result()
+        STATS.write_report()
+
+    def build_zips(self, args):
         """
-        LOGGER.info("in pre_run...")
+        The `build-zips` stage: build the HTML5 zips and copy the audio files
+        and thumbnails into ricecooker storage, from the API responses and the
+        media cached by the `fetch` stage.
+        """
+        args = dict(args, offline=True)
+        STATS.reset(profile=args["profile"])
+        if args["update"]:
+            remove_all_html5zips()
+        with ItemStore() as item_store:
+            self.prepare_items(args, item_store)
+        STATS.write_report()
 
-        # create faulty nodes JSON
-        if os.path.exists(FAILED_NODES):
-            os.remove(FAILED_NODES_JSON)
-        else:
-            os.makedirs(FAILED_NODES, exist_ok=True)
-        # create json file
-        with open(FAILED_NODES_JSON, 'w+'):
-            pass
+    def build_tree(self, args):
+        """
+        Build the ricecooker json tree for the entire channel.
+        """
+        STATS.reset(profile=args["profile"])
         if args["update"]:
-            LOGGER.info(
-                "Deleting all zips in cache dir {}".format(HTML5APP_ZIPS_LOCAL_DIR)
-            )
-            for zip_file in os.listdir(HTML5APP_ZIPS_LOCAL_DIR):
-                zip_file_abs_path = os.path.join(HTML5APP_ZIPS_LOCAL_DIR, zip_file)
-                if zip_file_abs_path.endswith(".zip"):
-                    os.remove(zip_file_abs_path)
+            remove_all_html5zips()
 
         ricecooker_json_tree = dict(
             # channel_id = 'e5d5dac2cd8d4059baddaa348714fa7c',  # test channel id
@@ -429,129 +2619,461 @@ class KamkalimaChef(JsonTreeChef):
             source_id="audios-and-texts_test-test",  # an alphanumeric channel ID
             description=KAMKALIMA_CHANNEL_DESCRIPTION,
             thumbnail="kk-logo.png",  # logo created from SVG
-            language=getlang("ar").code,  # language code of channel
-            children=[],
+            language=KAMKALIMA_LANGUAGE,  # language code of channel
         )
-        self.add_content_nodes(ricecooker_json_tree)
-
+        build_digest = get_build_digest(get_html5app_template_digest(), self.get_build_settings(args))
         json_tree_path = self.get_json_tree_path()
-        write_tree_to_json_tree(json_tree_path, ricecooker_json_tree)
+        if args["shard_workers"] or args["merge_shards"]:
+            if args["shard_workers"]:
+                self.build_shards(args, CHANNEL_SHARDS)
+            with JsonTreeWriter(json_tree_path) as tree_writer:
+                tree_writer.start_topic(ricecooker_json_tree)
+                changes, num_items = self.merge_shards(tree_writer, args["shard_dir"], build_digest)
+                tree_writer.end_topic()
+            log_item_changes(changes, num_items)
+        else:
+            item_manifest = ItemManifest(build_digest)
+            with JsonTreeWriter(json_tree_path) as tree_writer:
+                tree_writer.start_topic(ricecooker_json_tree)
+                self.add_content_nodes(tree_writer, args, item_manifest)
+                tree_writer.end_topic()
+            log_item_changes(item_manifest.get_changes(), len(item_manifest.current_items))
+            item_manifest.save()
+
+        LOGGER.info("Run report (saved to " + RUN_REPORT_JSON + "):")
+        STATS.write_report()
+
+    def build_machine_shards(self, args):
+        """
+        Only build the shards of machine I of M given by --shard: the channel
+        tree is assembled by a later run with --merge-shards.
+        """
+        shard_index, shard_count = args["shard"]
+        STATS.reset(profile=args["profile"])
+        self.build_shards(args, CHANNEL_SHARDS[shard_index::shard_count])
+        STATS.write_report()
 
-    def add_content_nodes(self, channel):
+    def get_build_settings(self, args):
         """
-        Build the hierarchy of topic nodes and content nodes.
+        Return the command line settings that change the content of the nodes.
         """
-        LOGGER.info("Creating channel content nodes...")
+        settings = {}
+        if args.get("optimize_images"):
+            settings["images"] = self.get_image_optimizer(args).settings_key
+        if args.get("transcode_audio"):
+            settings["audio"] = get_audio_profile_key(
+                args["audio_bitrate"], args["audio_channels"], args["audio_sample_rate"]
+            )
+        return settings
 
-        LOGGER.info("  Calling Kamkalima API to get authorization token.")
-        access_token = get_authentication_token()
+    def get_image_optimizer(self, args):
+        """
+        Return the `ImageOptimizer` for the --image-* options, or None when
+        --optimize-images is not set.
+        """
+        if not args.get("optimize_images"):
+            return None
+        return ImageOptimizer(args["image_max_width"], args["image_max_height"], args["image_quality"])
 
+    def get_audio_transcoder(self, args):
+        """
+        Return the `AudioTranscoder` for the --audio-* options, or None when
+        --transcode-audio is not set.
+        """
+        if not args.get("transcode_audio"):
+            return None
+        return AudioTranscoder(
+            args["audio_bitrate"], args["audio_channels"], args["audio_sample_rate"],
+            max_workers=args["transcode_workers"],
+        )
 
-        LOGGER.info("  Calling Kamkalima API to get texts items:")
-        all_texts_items = get_all_items(API_TEXTS_ENDPOINT, access_token)
-        texts_by_grade_and_theme = group_items_by_grade_and_theme(all_texts_items)
+    def add_content_nodes(self, tree_writer, args, item_manifest=None):
+        """
+        Build the hierarchy of topic nodes and content nodes, writing them to
+        `tree_writer` as they are produced. Unchanged items according to
+        `item_manifest` reuse their subtree from the last run.
+        """
+        LOGGER.info("Creating channel content nodes...")
+        with ItemStore() as item_store:
+            item_index, html5zips, audio_filenames, thumbnails = self.prepare_items(
+                args, item_store, item_manifest
+            )
+            with STATS.stage("tree_build"):
+                item_occurrences = get_item_occurrences(item_index)
+                item_topic_nodes = {}
+                for section in CHANNEL_SECTIONS:
+                    self.write_section_topic_node(
+                        tree_writer, section, item_index, item_occurrences, item_topic_nodes,
+                        html5zips, audio_filenames, item_manifest, thumbnails
+                    )
+        reused_zip_paths = item_manifest.reused_zip_paths if item_manifest else ()
+        remove_orphaned_html5zips(html5zips, keep_zip_paths=reused_zip_paths)
 
+    def prepare_items(self, args, item_store, item_manifest=None, include_item=None, replay_api_cache=False):
+        """
+        Fetch the items from the API into `item_store`, prepare their media and
+        group them by grade and theme. Only the items selected by `include_item` are kept
+        (see `fetch_and_prepare_items`), and with `replay_api_cache` the API
+        responses are read from the cache. Returns the `item_index` and the
+        `html5zips`, `audio_filenames` and `thumbnails` of the media pipeline.
+        """
+        api_cache = ApiResponseCache(offline=args["offline"] or replay_api_cache)
+        if api_cache.offline:
+            LOGGER.info("  Offline mode: replaying Kamkalima API responses from " + API_CACHE_DIR)
+            access_token = None
+        else:
+            LOGGER.info("  Calling Kamkalima API to get authorization token.")
+            with STATS.stage("auth"):
+                access_token = get_authentication_token()
+
+        # Texts and audios are fetched concurrently, and audio prefetching and
+        # zip building start on the first pages while later pages download
+        LOGGER.info("  Calling Kamkalima API to get texts and audios items:")
+        media_cache = MediaCache(offline=args["offline"])
+        with STATS.stage("fetch_and_prepare"):
+            audio_transcoder = self.get_audio_transcoder(args)
+            media_pipeline = MediaPipeline(
+                media_cache, args["audio_workers"], args["zip_workers"], item_manifest=item_manifest,
+                image_optimizer=self.get_image_optimizer(args), image_workers=args["image_workers"],
+                audio_transcoder=audio_transcoder,
+            )
+            with audio_transcoder or nullcontext(), media_pipeline:
+                fetch_and_prepare_items(
+                    access_token, media_pipeline, item_store, page_workers=args["page_workers"],
+                    cache=api_cache, include_item=include_item,
+                )
+                audio_filenames, html5zips, thumbnails = media_pipeline.get_results()
+        STATS.count("texts_items", item_store.count_items("text"))
+        STATS.count("audios_items", item_store.count_items("audio"))
+
+        LOGGER.info("Organizing items by grade and theme:")
+        with STATS.stage("grouping"):
+            item_index = item_store.get_item_index()
+        return item_index, html5zips, audio_filenames, thumbnails
+
+    def write_section_topic_node(self, tree_writer, section, item_index, item_occurrences,
+                                 item_topic_nodes, html5zips, audio_filenames, item_manifest=None,
+                                 thumbnails=None):
+        """
+        Write the topic node for one channel `section` (texts or audios) with its
+        grade and theme subtopics. Each item's topic node is built once (or
+        loaded from `item_manifest`) and the same node is reused for every theme
+        the item belongs to.
+        """
+        tree_writer.start_topic(get_section_topic_dict(section))
+        for grade_level in GRADE_ORDER:
+            self.write_grade_topic_node(
+                tree_writer, section, grade_level, item_index, item_occurrences, item_topic_nodes,
+                html5zips, audio_filenames, item_manifest, thumbnails
+            )
+        tree_writer.end_topic()
 
-        LOGGER.info("  Calling Kamkalima API to get audios items:")
-        all_audios_items = get_all_items(API_AUDIOS_ENDPOINT, access_token)
-        audios_by_grade_and_theme = group_items_by_grade_and_theme(all_audios_items)
+    def write_grade_topic_node(self, tree_writer, section, grade_level, item_index, item_occurrences,
+                               item_topic_nodes, html5zips, audio_filenames, item_manifest=None,
+                               thumbnails=None):
+        """
+        Write the topic node for one `grade_level` of `section` with its theme
+        subtopics, see `write_section_topic_node`. Nothing is written if the
+        grade has no items.
+        """
+        grade_source_id = section["source_id"] + "_" + grade_level
+        grade_started = False
+        for (item_type, item_grade_level, theme), items in item_index.items():
+            if item_type != section["item_type"] or item_grade_level != grade_level:
+                continue
+            if not grade_started:
+                tree_writer.start_topic(dict(
+                    kind = content_kinds.TOPIC,
+                    source_id = grade_source_id,
+                    title = grade_level,
+                ))
+                grade_started = True
+
+            tree_writer.start_topic(dict(
+                kind=content_kinds.TOPIC,
+                source_id= grade_source_id + "_" + theme,
+                title=theme,
+            ))
+            for item in items:
+                item_key = (item_type, str(item["id"]))
+                if item_key not in item_topic_nodes:
+                    topic_node = item_manifest.load_subtree(item_type, item) if item_manifest else None
+                    STATS.cache_lookup("subtree_cache", topic_node is not None)
+                    if topic_node is None:
+                        with STATS.timed("transform"):
+                            topic_node = topic_node_from_item(
+                                item_type, item, html5zips=html5zips, audio_filenames=audio_filenames,
+                                thumbnails=thumbnails,
+                            )
+                        if item_manifest:
+                            item_manifest.save_subtree(item_type, item, topic_node)
+                    item_topic_nodes[item_key] = topic_node
+                with STATS.timed("tree_write"):
+                    tree_writer.add_node(item_topic_nodes[item_key])
+                item_occurrences[item_key] -= 1
+                if item_occurrences[item_key] == 0:
+                    del item_topic_nodes[item_key]
+            tree_writer.end_topic()
+
+        if grade_started:
+            tree_writer.end_topic()
+
+    def build_shards(self, args, shards):
+        """
+        Build `shards` on a pool of --shard-workers processes (see `build_shard`).
+        The API pages are fetched once here and replayed from the cache by the
+        shard builds.
+        """
+        if not args["offline"]:
+            with STATS.stage("auth"):
+                access_token = get_authentication_token()
+            with STATS.stage("fetch"):
+                api_cache = ApiResponseCache()
+                for endpoint in [API_TEXTS_ENDPOINT, API_AUDIOS_ENDPOINT]:
+                    get_all_items(endpoint, access_token, max_workers=args["page_workers"], cache=api_cache)
+        os.makedirs(args["shard_dir"], exist_ok=True)
+        LOGGER.info("Building %s shards using %s processes" % (len(shards), max(args["shard_workers"], 1)))
+        # importing ricecooker.config deletes and recreates its temp dir, so
+        # import it here once and fork the workers, which then inherit it
+        importlib.import_module("ricecooker.config")
+        context = multiprocessing.get_context("fork")
+        with STATS.stage("shards"):
+            with ProcessPoolExecutor(max_workers=max(args["shard_workers"], 1), mp_context=context) as executor:
+                futures = [
+                    executor.submit(run_shard_build, args, shard["shard_id"], args["shard_dir"])
+                    for shard in shards
+                ]
+                for future in futures:
+                    future.result()
+
+    def build_shard(self, args, shard_id, shard_dir):
+        """
+        Build the grade topic node of the shard `shard_id` into
+        `<shard_dir>/<shard_id>.json` (an empty file if the grade has no items),
+        then save `<shard_id>.report.json`, which marks the shard as complete.
+        Each shard has its own item manifest and subtrees (in
+        `<shard_dir>/subtrees/<shard_id>/`) for delta syncs.
+        """
+        shard = [shard for shard in CHANNEL_SHARDS if shard["shard_id"] == shard_id][0]
+        shard_path = os.path.join(shard_dir, shard_id + ".json")
+        report_path = os.path.join(shard_dir, shard_id + ".report.json")
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        build_digest = get_build_digest(get_html5app_template_digest(), self.get_build_settings(args))
+        item_manifest = ItemManifest(
+            build_digest,
+            manifest_path=os.path.join(shard_dir, shard_id + ".manifest.json"),
+            subtrees_dir=os.path.join(shard_dir, "subtrees", shard_id),
+        )
+        LOGGER.info("Building shard " + shard_id)
+        item_store_path = os.path.join(os.path.dirname(ITEM_STORE_PATH), "item_store-" + shard_id + ".sqlite3")
+        with ItemStore(item_store_path) as item_store:
+            item_index, html5zips, audio_filenames, thumbnails = self.prepare_items(
+                args, item_store, item_manifest,
+                include_item=lambda item_type, item: get_item_shard_id(item_type, item) == shard_id,
+                replay_api_cache=True,
+            )
+            with STATS.stage("tree_build"):
+                with JsonTreeWriter(shard_path) as tree_writer:
+                    self.write_grade_topic_node(
+                        tree_writer, shard["section"], shard["grade_level"], item_index,
+                        get_item_occurrences(item_index), {}, html5zips, audio_filenames, item_manifest,
+                        thumbnails
+                    )
+        zip_paths = set(zip_path for zip_path, _ in html5zips.values()) | item_manifest.reused_zip_paths
+        shard_report = dict(
+            build_digest=build_digest,
+            item_changes=item_manifest.get_changes(),
+            num_items=len(item_manifest.current_items),
+            zip_paths=sorted(zip_paths),
+            report=STATS.get_report(),
+        )
+        item_manifest.save()
+        with open(report_path + ".tmp", "w") as report_file:
+            json.dump(shard_report, report_file, indent=2, ensure_ascii=False)
+        os.replace(report_path + ".tmp", report_path)
 
-        all_audio_grade_levels = set(audios_by_grade_and_theme.keys())
-        all_text_grade_levels = set(texts_by_grade_and_theme.keys())
+    def merge_shards(self, tree_writer, shard_dir, build_digest):
+        """
+        Write the sections of the channel to `tree_writer` from the shards in
+        `shard_dir`, in canonical order. All shards must have been built with
+        the same `build_digest`. Returns the item changes of all the shards
+        and the number of items.
+        """
+        shard_reports = {}
+        for shard in CHANNEL_SHARDS:
+            report_path = os.path.join(shard_dir, shard["shard_id"] + ".report.json")
+            if not os.path.exists(report_path):
+                raise RuntimeError("Shard " + shard["shard_id"] + " is missing from " + shard_dir)
+            with open(report_path, encoding="utf-8") as report_file:
+                shard_reports[shard["shard_id"]] = json.load(report_file)
+            if shard_reports[shard["shard_id"]]["build_digest"] != build_digest:
+                raise RuntimeError("Shard " + shard["shard_id"] + " was built with other chef code or settings")
+
+        with STATS.stage("merge"):
+            for section in CHANNEL_SECTIONS:
+                tree_writer.start_topic(get_section_topic_dict(section))
+                for shard in CHANNEL_SHARDS:
+                    shard_path = os.path.join(shard_dir, shard["shard_id"] + ".json")
+                    if shard["section"] is section and os.path.getsize(shard_path):
+                        tree_writer.add_serialized_node(shard_path)
+                tree_writer.end_topic()
+
+        keep_zip_paths = []
+        changes = dict(added=[], changed=[], removed=[])
+        for shard_report in shard_reports.values():
+            keep_zip_paths.extend(shard_report["zip_paths"])
+            for change, keys in shard_report["item_changes"].items():
+                changes[change].extend(keys)
+        remove_orphaned_html5zips({}, keep_zip_paths=keep_zip_paths)
+        STATS.set_info("shards", {shard_id: report["report"] for shard_id, report in shard_reports.items()})
+        num_items = sum(shard_report["num_items"] for shard_report in shard_reports.values())
+        return {change: sorted(keys) for change, keys in changes.items()}, num_items
+
+
+def log_item_changes(changes, num_items):
+    LOGGER.info("Items added: %s, changed: %s, removed: %s, unchanged: %s" % (
+        len(changes["added"]), len(changes["changed"]), len(changes["removed"]),
+        num_items - len(changes["added"]) - len(changes["changed"]),
+    ))
+    STATS.set_info("item_changes", changes)
+
+
+def parse_shard_arg(value):
+    """
+    Parse the --shard value `I/M` into `(I, M)`.
+    """
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError("expected I/M with 0 <= I < M, e.g. 0/4")
+    return int(match.group(1)), int(match.group(2))
 
 
-        # add all texts into Reading Comprehension topic (قراءة الفهم)
-        reading_topic_node = dict(
-            kind = content_kinds.TOPIC,
-            source_id = "reading_comprehension",
-            title = "دراسة نص",
-            children = []
-        )
-        grade_key = {
-            4 : "صف ٤-٦",
-            7 : "صف ٧-٩",
-            10 : "صف ١٠-١٢"
-        }
-        grade_arr = ["صف ٤-٦", "صف ٧-٩", "صف ١٠-١٢"]
-
-        LOGGER.info("Organizing text items by theme:")
-        # ordering by grade
-        for grade in grade_arr:
-            for grade_level in all_text_grade_levels:
-                if grade_level == grade:
-                    all_text_grade_level_themes = set(texts_by_grade_and_theme[grade_level].keys())
-                    grade_source_id = "reading_comprehension_" + grade_level
-                    grade_topic_node = dict(
-                        kind = content_kinds.TOPIC,
-                        source_id = grade_source_id,
-                        title = grade_level,
-                        children = []
-                    )
+def run_shard_build(args, shard_id, shard_dir):
+    """
+    Build one shard in a worker process of `KamkalimaChannelBuilder.build_shards`.
+    """
+    global _SESSION, _SCHEDULER
+    _SESSION = _SCHEDULER = None  # don't share the parent's pooled connections
+    STATS.reset(profile=False)
+    KamkalimaChannelBuilder().build_shard(args, shard_id, shard_dir)
 
-                    for theme in all_text_grade_level_themes:
-                        theme_topic_node = dict(
-                            kind=content_kinds.TOPIC,
-                            source_id= grade_source_id + "_" + theme,
-                            title=theme,
-                            children=[]
-                        )
-                        text_items = texts_by_grade_and_theme[grade_level][theme]
-                        for text_item in text_items:
-                            child_topic = topic_node_from_item("text", text_item)
-                            theme_topic_node["children"].append(child_topic)
-                        grade_topic_node["children"].append(theme_topic_node)
-                    
-                    reading_topic_node["children"].append(grade_topic_node)
-
-        channel["children"].append(reading_topic_node)
-
-
-        # add all audio into Listening Comprehension topic
-        listening_topic_node = dict(
-            kind = content_kinds.TOPIC,
-            source_id = "listening_comprehension",
-            title = "إصغاء",
-            children = []
-        )
 
-        LOGGER.info("Organizing audio items by theme:")
-        for grade in grade_arr: 
-            for grade_level in all_audio_grade_levels:
-                if grade_level == grade:
-                    all_audio_grade_level_themes = set(audios_by_grade_and_theme[grade_level].keys())
-                    grade_source_id = "listening_comprehension_" + grade_level
-                    grade_topic_node = dict(
-                        kind = content_kinds.TOPIC,
-                        source_id = grade_source_id,
-                        title = grade_level,
-                        children = []
-                    )
-                    
-                    for theme in all_audio_grade_level_themes:
-                        theme_topic_node = dict(
-                            kind=content_kinds.TOPIC,
-                            source_id= grade_source_id + "_" + theme,
-                            title=theme,
-                            children=[]
-                        )
-                        audio_items = audios_by_grade_and_theme[grade_level][theme]
-                        for audio_item in audio_items:
-                            child_topic = topic_node_from_item("audio", audio_item)
-                            theme_topic_node["children"].append(child_topic)
-                        grade_topic_node["children"].append(theme_topic_node)
-
-                    listening_topic_node["children"].append(grade_topic_node)
-                    
-        channel['children'].append(listening_topic_node)
 
+def make_chef_class():
+    """
+    Return the `KamkalimaChef` class. It is only created when it's used (see
+    `__getattr__`) because importing ricecooker's chef classes is slow.
+    """
+    from ricecooker.chefs import JsonTreeChef
+    from ricecooker.utils.tokens import get_content_curation_token
+
+    class KamkalimaChef(KamkalimaChannelBuilder, JsonTreeChef):
+        """
+        The chef class that takes care of uploading channel to Kolibri Studio.
+        We'll call its `main()` method from the command line script.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super(KamkalimaChef, self).__init__(*args, **kwargs)
+            self.arg_parser = argparse.ArgumentParser(
+                description="Build the Kamkalima channel and upload it to Kolibri Studio.",
+                parents=[self.arg_parser],
+            )
+            add_chef_arguments(self.arg_parser)
+
+        def parse_args_and_options(self):
+            """
+            The `upload` command is `uploadchannel` with the json tree built by
+            a previous `build-tree` run.
+            """
+            args, options = super(KamkalimaChef, self).parse_args_and_options()
+            args["upload_only"] = args["command"] == "upload"
+            if args["upload_only"]:
+                args["command"] = "uploadchannel"
+                args["token"] = get_content_curation_token(args["token"])
+            return args, options
+
+        def run(self, args, options):
+            """
+            With --shard, only build this machine's shards (see `build_machine_shards`).
+            """
+            if args["shard"] is not None:
+                self.build_machine_shards(args)
+                return
+            super(KamkalimaChef, self).run(args, options)
+
+        def pre_run(self, args, options):
+            """
+            Build the ricecooker json tree for the entire channel, unless it's
+            only uploaded.
+            """
+            if args.get("upload_only"):
+                json_tree_path = self.get_json_tree_path()
+                if not os.path.exists(json_tree_path):
+                    raise RuntimeError("No json tree at " + json_tree_path + ", run build-tree first")
+                LOGGER.info("Uploading the json tree " + json_tree_path)
+                return
+            LOGGER.info("in pre_run...")
+            self.build_tree(args)
+
+    return KamkalimaChef
+
+
+def __getattr__(name):
+    """
+    Create `KamkalimaChef` the first time it is accessed as a module attribute.
+    """
+    if name == "KamkalimaChef":
+        globals()[name] = make_chef_class()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 # CLI
 ################################################################################
+# The stage commands run one stage of the chef against the local state in
+# chefdata/ and only import what that stage needs. `upload` is handled by
+# `KamkalimaChef`, as are the usual ricecooker commands (dryrun, uploadchannel).
+
+STAGE_COMMANDS = ["fetch", "build-zips", "build-tree"]
+
+
+def run_stage(argv):
+    """
+    Run the stage command given in `argv` (the command line arguments).
+    """
+    parser = argparse.ArgumentParser(
+        description="Run one stage of the Kamkalima chef: fetch the API responses and media, "
+                    "then build-zips and build-tree offline from the local caches. "
+                    "Use `upload` to upload the json tree to Kolibri Studio.",
+    )
+    parser.add_argument("command", choices=STAGE_COMMANDS, help="Stage to run.")
+    parser.add_argument("--update", action="store_true", help="Rebuild all the HTML5 zips.")
+    parser.add_argument("--debug", action="store_true", help="Print debugging log messages.")
+    add_chef_arguments(parser)
+    args = vars(parser.parse_args(argv))
+    logging.basicConfig(
+        level=logging.DEBUG if args["debug"] else logging.INFO,
+        format="%(levelname)-8s %(message)s",
+    )
+    builder = KamkalimaChannelBuilder()
+    if args["command"] == "fetch":
+        builder.fetch_content(args)
+    elif args["command"] == "build-zips":
+        builder.build_zips(args)
+    elif args["shard"] is not None:
+        builder.build_machine_shards(dict(args, offline=True))
+    else:
+        builder.build_tree(dict(args, offline=True))
+
 
 if __name__ == "__main__":
     """
     This code will run when the sushi chef scripy is called on the command line.
     """
-    chef = KamkalimaChef()
-    chef.main()
+    if sys.argv[1:2] and sys.argv[1] in STAGE_COMMANDS:
+        run_stage(sys.argv[1:])
+    else:
+        chef = make_chef_class()()
+        chef.main()